@@ -0,0 +1,291 @@
+#! /usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Benchmark gerrit-projects against a local fake Gerrit.
+#
+#   python benchmarks/bench.py --projects 1000 --latency 0.005 --jobs 4
+#
+# A synthetic projects.yaml is generated and the tool is run as a child
+# process several times against the same fake server:
+#
+#   cold  - empty server and cache-dir, every project gets created
+#   warm  - everything exists, state.json is ignored (--force)
+#   noop  - nothing changed since the previous run
+#   fresh-cache - everything exists but cache-dir is empty, as on a new
+#           host (not run by default)
+#
+# For each run wall time, Gerrit requests (SSH commands and, with --rest,
+# REST calls, by type), connections, the subprocesses the tool started
+# (from the EXEC entries of its --trace) and its peak RSS are reported.
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks.fake_gerrit import FakeGerrit  # noqa
+
+ACL_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'config')
+RUNS = ['cold', 'warm', 'noop', 'fresh-cache']
+DEFAULT_RUNS = ['cold', 'warm', 'noop']
+
+# Runs gerrit-projects in the child and records its own peak RSS on exit.
+BOOTSTRAP = """
+import atexit, resource, sys
+rss_file = sys.argv.pop(1)
+def _rss():
+    with open(rss_file, 'w') as fp:
+        fp.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+atexit.register(_rss)
+sys.argv[0] = 'gerrit-projects'
+import gerrit_projects.projects
+gerrit_projects.projects.main()
+"""
+
+# ssh reads known_hosts from the passwd home directory, not $HOME, so point
+# it at the working directory explicitly.
+SSH_SHIM = """#!/bin/sh
+exec %(ssh)s -o UserKnownHostsFile=%(known_hosts)s "$@"
+"""
+
+
+def which(program):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def generate_projects(path, count, upstream=None, upstream_every=0):
+    acls = ['Low-Impact-Project.config'] * 16 + \
+           ['Significant-Impact-Project.config'] * 3 + [None]
+    with open(path, 'w') as fp:
+        for i in range(count):
+            name = 'bench/group-%03d/project-%05d' % (i // 100, i)
+            fp.write("- project: %s\n" % name)
+            fp.write("  description: Synthetic project %d\n" % i)
+            acl = acls[i % len(acls)]
+            if acl:
+                fp.write("  acl-config: %s\n" % acl)
+            if upstream and upstream_every and i % upstream_every == 0:
+                fp.write("  upstream: %s\n" % upstream)
+                fp.write("  upstream-prefix: upstream\n")
+                fp.write("  options:\n   - track-upstream\n")
+
+
+def make_upstream(path, branches):
+    env = dict(os.environ, GIT_AUTHOR_NAME='Upstream',
+               GIT_AUTHOR_EMAIL='upstream@example.com',
+               GIT_COMMITTER_NAME='Upstream',
+               GIT_COMMITTER_EMAIL='upstream@example.com')
+    subprocess.check_call(['git', 'init', '-q', path], env=env)
+    subprocess.check_call(['git', '-C', path, 'commit', '-q',
+                           '--allow-empty', '-m', 'Initial'], env=env)
+    for i in range(branches):
+        subprocess.check_call(['git', '-C', path, 'branch',
+                               'branch-%04d' % i], env=env)
+
+
+def write_ini(path, workdir, port, key_file, jobs_connections, extra):
+    user = os.environ.get('USER') or 'root'
+    group = subprocess.check_output(['id', '-gn']).decode('utf-8').strip()
+    with open(path, 'w') as fp:
+        fp.write("[projects]\n")
+        fp.write("gerrit-host=127.0.0.1\n")
+        fp.write("gerrit-port=%d\n" % port)
+        fp.write("gerrit-user=bench\n")
+        fp.write("gerrit-key=%s\n" % key_file)
+        fp.write("gerrit-committer=Bench <bench@example.com>\n")
+        fp.write("local-git-dir=%s\n" % os.path.join(workdir, 'git'))
+        fp.write("cache-dir=%s\n" % os.path.join(workdir, 'cache'))
+        fp.write("acl-dir=%s\n" % ACL_DIR)
+        fp.write("gerrit-system-user=%s\n" % user)
+        fp.write("gerrit-system-group=%s\n" % group)
+        fp.write("gerrit-ssh-connections=%d\n" % jobs_connections)
+        for option in extra:
+            fp.write("%s\n" % option)
+
+
+def run_tool(workdir, ini, yaml_file, jobs, extra_args):
+    trace = os.path.join(workdir, 'trace.jsonl')
+    rss_file = os.path.join(workdir, 'rss')
+    for f in (trace, rss_file):
+        if os.path.exists(f):
+            os.unlink(f)
+    env = dict(os.environ)
+    env['PATH'] = '%s%s%s' % (os.path.join(workdir, 'bin'), os.pathsep,
+                              env.get('PATH', ''))
+    # Keep ssh's known_hosts and git's identity out of the real $HOME
+    env['HOME'] = os.path.join(workdir, 'home')
+    env['GIT_COMMITTER_NAME'] = 'Bench'
+    env['GIT_COMMITTER_EMAIL'] = 'bench@example.com'
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(ACL_DIR), env.get('PYTHONPATH', '')])
+    cmd = [sys.executable, '-c', BOOTSTRAP, rss_file,
+           '--conf', ini, '--project_conf', yaml_file,
+           '--jobs', str(jobs), '--trace', trace] + extra_args
+    start = time.time()
+    rc = subprocess.call(cmd, env=env)
+    wall = time.time() - start
+    subprocesses = 0
+    if os.path.exists(trace):
+        with open(trace) as fp:
+            for line in fp:
+                if json.loads(line).get('type') == 'exec':
+                    subprocesses += 1
+    rss_kb = 0
+    if os.path.exists(rss_file):
+        with open(rss_file) as fp:
+            rss_kb = int(fp.read() or 0)
+    return dict(returncode=rc, wall=wall, subprocesses=subprocesses,
+                peak_rss_mb=rss_kb / 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark gerrit-projects against a fake Gerrit')
+    parser.add_argument('--projects', type=int, default=100,
+                        help='number of projects to generate')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every SSH command')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='passed to gerrit-projects --jobs')
+    parser.add_argument('--runs', default=','.join(DEFAULT_RUNS),
+                        help='comma separated runs, from %s' % RUNS)
+    parser.add_argument('--upstream-every', type=int, default=0,
+                        help='make every Nth project track an upstream')
+    parser.add_argument('--upstream-branches', type=int, default=50,
+                        help='branches in the synthetic upstream')
+    parser.add_argument('--rest', action='store_true',
+                        help='use the rest backend against the fake '
+                             'server\'s REST API')
+    parser.add_argument('--no-replication', action='store_true',
+                        help='do not serve projects out of local-git-dir, '
+                             'so local mirrors stay empty')
+    parser.add_argument('--option', action='append', default=[],
+                        help='extra key=value line for projects.ini')
+    parser.add_argument('--tool-arg', action='append', default=[],
+                        help='extra argument for every gerrit-projects run')
+    parser.add_argument('--json', dest='json_file',
+                        help='also write results to this file')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the working directory')
+    parser.add_argument('-d', dest='debug', action='store_true',
+                        help='debug output from the fake server')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR)
+    if not args.debug:
+        # Clients hanging up on the fake sshd are not worth reporting
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    runs = [r for r in args.runs.split(',') if r]
+    for r in runs:
+        if r not in RUNS:
+            parser.error("unknown run %s" % r)
+
+    workdir = tempfile.mkdtemp(prefix='gerrit-projects-bench-')
+    try:
+        for d in ('bin', 'home', 'git', 'cache'):
+            os.makedirs(os.path.join(workdir, d))
+        shim = os.path.join(workdir, 'bin', 'ssh')
+        with open(shim, 'w') as fp:
+            fp.write(SSH_SHIM % dict(
+                ssh=which('ssh'),
+                known_hosts=os.path.join(workdir, 'known_hosts')))
+        os.chmod(shim, 0o755)
+
+        key_file = os.path.join(workdir, 'id_rsa')
+        paramiko.ECDSAKey.generate().write_private_key_file(key_file)
+
+        if args.no_replication:
+            server_root = os.path.join(workdir, 'server')
+        else:
+            # Serving straight out of local-git-dir behaves like instant
+            # replication to the local mirrors.
+            server_root = os.path.join(workdir, 'git')
+        gerrit = FakeGerrit(server_root, args.latency).start()
+        options = list(args.option)
+        if args.rest:
+            options.extend(['gerrit-backend=rest',
+                            'gerrit-url=http://127.0.0.1:%d' %
+                            gerrit.start_http()])
+
+        upstream = None
+        if args.upstream_every:
+            upstream = os.path.join(workdir, 'upstream')
+            make_upstream(upstream, args.upstream_branches)
+        yaml_file = os.path.join(workdir, 'projects.yaml')
+        generate_projects(yaml_file, args.projects, upstream,
+                          args.upstream_every)
+        ini = os.path.join(workdir, 'projects.ini')
+        write_ini(ini, workdir, gerrit.port, key_file,
+                  max(1, min(args.jobs, 4)), options)
+
+        results = []
+        for run in runs:
+            extra = list(args.tool_arg)
+            if run == 'warm':
+                extra.append('--force')
+            elif run == 'fresh-cache':
+                shutil.rmtree(os.path.join(workdir, 'cache'))
+                os.makedirs(os.path.join(workdir, 'cache'))
+            gerrit.reset_counters()
+            result = run_tool(workdir, ini, yaml_file, args.jobs, extra)
+            counters = gerrit.reset_counters()
+            result['run'] = run
+            result['connections'] = (counters.pop('connections', 0) +
+                                     counters.pop('http-connections', 0))
+            result['requests'] = sum(counters.values())
+            result['by_request'] = dict(counters)
+            results.append(result)
+
+        print("%-11s %9s %10s %9s %9s %9s" % (
+            'run', 'wall(s)', 'requests', 'conns', 'subprocs', 'rss(MB)'))
+        for r in results:
+            print("%-11s %9.2f %10d %9d %9d %9.1f%s" % (
+                r['run'], r['wall'], r['requests'], r['connections'],
+                r['subprocesses'], r['peak_rss_mb'],
+                '' if r['returncode'] == 0 else
+                '  (exit %d)' % r['returncode']))
+            for command, count in sorted(r['by_request'].items()):
+                print("              %-28s %d" % (command, count))
+        if args.json_file:
+            with open(args.json_file, 'w') as fp:
+                json.dump(dict(projects=args.projects, latency=args.latency,
+                               jobs=args.jobs, rest=args.rest,
+                               results=results),
+                          fp, indent=1, sort_keys=True)
+        gerrit.stop()
+    finally:
+        if args.keep:
+            print("Working directory kept in %s" % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,636 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# A stand-in for Gerrit's sshd, good enough to drive gerrit-projects.
+#
+# Projects are plain bare repositories under a root directory.  The gerrit
+# commands used by the tool are answered from memory, git-upload-pack and
+# git-receive-pack are served from the bare repositories, and every command
+# can be delayed by a fixed latency.  start_http() adds the subset of the
+# REST API used by the rest backend, backed by the same state.
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+import six.moves
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+DEFAULT_GROUPS = ['Administrators', 'Non-Interactive Users']
+SYSTEM_GROUPS = ['Anonymous Users', 'Change Owner',
+                 'Project Owners', 'Registered Users']
+PROJECT_CONFIG = """[project]
+\tdescription = %s
+[access]
+\tinheritFrom = All-Projects
+"""
+GIT_ENV = dict(GIT_AUTHOR_NAME='Fake Gerrit',
+               GIT_AUTHOR_EMAIL='gerrit@example.com',
+               GIT_COMMITTER_NAME='Fake Gerrit',
+               GIT_COMMITTER_EMAIL='gerrit@example.com')
+
+
+class CommandError(Exception):
+    pass
+
+
+def group_uuid(name):
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, gerrit):
+        self.gerrit = gerrit
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if not isinstance(command, str):
+            command = command.decode('utf-8')
+        t = threading.Thread(target=self.gerrit.handle,
+                             args=(channel, command))
+        t.daemon = True
+        t.start()
+        return True
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _RESTHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.gerrit.count('http-connections')
+
+    def log_message(self, format, *args):
+        self.server.gerrit.log.debug(format % args)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = None
+        if length:
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        status, result = self.server.gerrit.handle_rest(
+            self.command, self.path, data)
+        if isinstance(result, str) and status >= 400:
+            body = result.encode('utf-8')
+            content_type = 'text/plain; charset=UTF-8'
+        else:
+            body = (")]}'\n" + json.dumps(result)).encode('utf-8')
+            content_type = 'application/json; charset=UTF-8'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+
+class FakeGerrit(object):
+    log = logging.getLogger("benchmarks.FakeGerrit")
+
+    def __init__(self, root, latency=0.0, host_key=None):
+        self.root = root
+        self.latency = float(latency)
+        self.host_key = host_key or paramiko.ECDSAKey.generate()
+        self.port = None
+        self.counters = collections.Counter()
+        self.groups = dict((name, group_uuid(name))
+                           for name in DEFAULT_GROUPS)
+        self.descriptions = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._sock = None
+        self._http = None
+        self.http_port = None
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        for name in self._scan_projects():
+            self.descriptions[name] = None
+
+    def _scan_projects(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for d in list(dirnames):
+                if d.endswith('.git'):
+                    path = os.path.join(dirpath, d)
+                    yield os.path.relpath(path, self.root)[:-len('.git')]
+                    dirnames.remove(d)
+
+    def start(self, port=0):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', port))
+        self._sock.listen(128)
+        self.port = self._sock.getsockname()[1]
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+        return self
+
+    def start_http(self, port=0):
+        """Serve the REST API too; returns its port."""
+        self._http = _HTTPServer(('127.0.0.1', port), _RESTHandler)
+        self._http.gerrit = self
+        t = threading.Thread(target=self._http.serve_forever)
+        t.daemon = True
+        t.start()
+        self.http_port = self._http.server_address[1]
+        return self.http_port
+
+    def stop(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        if self._http:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def reset_counters(self):
+        with self._lock:
+            counters = self.counters
+            self.counters = collections.Counter()
+        return counters
+
+    def _accept(self):
+        while self._sock:
+            try:
+                conn, addr = self._sock.accept()
+            except (socket.error, AttributeError):
+                return
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=_ServerInterface(self))
+        except (paramiko.SSHException, EOFError, socket.error):
+            return
+        with self._lock:
+            self.counters['connections'] += 1
+        # Channels are handled from the exec request; accepting them just
+        # keeps paramiko's queue drained.  Hold on to them until they close,
+        # a dropped Channel closes itself when it is garbage collected.
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            channels = [c for c in channels if not c.closed]
+            if channel is not None:
+                channels.append(channel)
+
+    def handle(self, channel, command):
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            argv = command.split()
+        if argv and argv[0] == 'gerrit' and len(argv) > 1:
+            key = 'gerrit %s' % argv[1]
+        else:
+            key = argv[0] if argv else ''
+        self.count(key)
+        if self.latency:
+            time.sleep(self.latency)
+        rc = 0
+        try:
+            if key in ('git-upload-pack', 'git-receive-pack'):
+                rc = self._git(channel, argv)
+            elif key == 'gerrit stream-events':
+                self._stream_events(channel)
+            else:
+                method = getattr(self, 'cmd_%s' % key.replace(
+                    'gerrit ', '').replace('-', '_').replace(' ', '_'),
+                    None)
+                if method is None:
+                    raise CommandError("fatal: %s: not found" % key)
+                channel.sendall(method(argv[2:]).encode('utf-8'))
+        except CommandError as e:
+            channel.sendall_stderr(('%s\n' % e).encode('utf-8'))
+            rc = 1
+        except Exception:
+            self.log.exception("Failed handling %s" % command)
+            rc = 1
+        try:
+            channel.send_exit_status(rc)
+            channel.shutdown_write()
+            # Closing right away can beat paramiko's reply to the exec
+            # request, which clients treat as failure; wait until the client
+            # is done sending (OpenSSH) or has closed itself (paramiko).
+            deadline = time.time() + 10
+            while not (channel.closed or channel.eof_received) and \
+                    time.time() < deadline:
+                time.sleep(0.01)
+            channel.close()
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+
+    # REST
+
+    def handle_rest(self, method, path, data):
+        """Return (status, JSON-able result or error text)."""
+        url = six.moves.urllib.parse.urlsplit(path)
+        query = six.moves.urllib.parse.parse_qs(url.query,
+                                                keep_blank_values=True)
+        parts = [six.moves.urllib.parse.unquote(part)
+                 for part in url.path.strip('/').split('/')]
+        if parts and parts[0] == 'a':
+            parts = parts[1:]
+        collection = parts[0] if parts else ''
+        key = '%s %s' % (method, '/'.join(
+            [collection] + parts[2:3]))
+        self.count(key)
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            method_name = 'rest_%s_%s' % (method.lower(), '_'.join(
+                [collection] + parts[2:3]).replace('/', '_'))
+            handler = getattr(self, method_name, None)
+            if handler is None:
+                return 404, 'Not found'
+            return handler(parts[1] if len(parts) > 1 else None,
+                           query, data or {})
+        except CommandError as e:
+            return 409, str(e)
+        except KeyError as e:
+            return 404, 'Not found: %s' % e
+        except Exception:
+            self.log.exception("Failed handling %s %s" % (method, path))
+            return 500, 'Internal error'
+
+    def rest_get_projects(self, name, query, data):
+        prefix = query.get('p', [None])[0]
+        branch = query.get('b', [None])[0]
+        result = {}
+        with self._lock:
+            items = sorted(self.descriptions.items())
+        for project, description in items:
+            if prefix and not project.startswith(prefix):
+                continue
+            info = dict(id=six.moves.urllib.parse.quote(project, safe=''))
+            if branch:
+                revision = self._branch(project, branch)
+                if not revision:
+                    continue
+                info['branches'] = {branch: revision}
+            if 'd' in query and description:
+                info['description'] = description
+            result[project] = info
+        return 200, result
+
+    def rest_put_projects(self, name, query, data):
+        args = ['--name', name]
+        if data.get('description'):
+            args.extend(['--description', data['description']])
+        if data.get('create_empty_commit'):
+            args.append('--empty-commit')
+        self.cmd_create_project(args)
+        return 201, dict(id=six.moves.urllib.parse.quote(name, safe=''),
+                         name=name)
+
+    def rest_put_projects_description(self, name, query, data):
+        self.cmd_set_project([name, '--description',
+                              data.get('description') or ''])
+        return 200, data.get('description') or ''
+
+    def rest_put_projects_config(self, name, query, data):
+        self.cmd_set_project([name])
+        return 200, {}
+
+    def rest_get_projects_branches(self, name, query, data):
+        path, name = self.repo_path(name)
+        if not os.path.isdir(path):
+            raise KeyError(name)
+        return 200, [dict(ref=ref, revision=sha) for ref, sha in
+                     sorted(self._refs(path).items())
+                     if ref.startswith('refs/heads/')]
+
+    def _group_info(self, name, uuid):
+        return dict(id=uuid, name=name, group_id=1, owner='Administrators',
+                    owner_id=self.groups['Administrators'],
+                    options=dict(visible_to_all=True))
+
+    def rest_get_groups(self, name, query, data):
+        with self._lock:
+            groups = dict(self.groups)
+        if name:
+            return 200, self._group_info(name, groups[name])
+        return 200, dict((group, self._group_info(group, uuid))
+                         for group, uuid in groups.items())
+
+    def rest_put_groups(self, name, query, data):
+        self.cmd_create_group([name])
+        return 201, self._group_info(name, self.groups[name])
+
+    def rest_get_config_version(self, name, query, data):
+        return 200, '2.13.0-fake'
+
+    def rest_get_plugins(self, name, query, data):
+        return 200, {}
+
+    # Events
+
+    def emit(self, event):
+        event['eventCreatedOn'] = int(time.time())
+        with self._lock:
+            listeners = list(self._listeners)
+        for q in listeners:
+            q.put(event)
+
+    def _stream_events(self, channel):
+        q = six.moves.queue.Queue()
+        with self._lock:
+            self._listeners.append(q)
+        try:
+            while not channel.closed and channel.get_transport().is_active():
+                try:
+                    event = q.get(timeout=1)
+                except six.moves.queue.Empty:
+                    continue
+                channel.sendall((json.dumps(event) + '\n').encode('utf-8'))
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+        finally:
+            with self._lock:
+                self._listeners.remove(q)
+
+    # Git
+
+    def repo_path(self, name):
+        name = name.strip('/')
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        return os.path.join(self.root, '%s.git' % name), name
+
+    def _git_output(self, path, *args, **kwargs):
+        env = dict(os.environ)
+        env.update(GIT_ENV)
+        p = subprocess.Popen(('git', '--git-dir=%s' % path) + args,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, env=env)
+        out, err = p.communicate(kwargs.get('data'))
+        if p.returncode:
+            raise CommandError(err.decode('utf-8'))
+        return out.decode('utf-8').strip()
+
+    def _refs(self, path):
+        refs = {}
+        out = self._git_output(path, 'for-each-ref',
+                               '--format=%(objectname) %(refname)')
+        for line in out.splitlines():
+            sha, ref = line.split(' ', 1)
+            refs[ref] = sha
+        return refs
+
+    def _git(self, channel, argv):
+        if len(argv) < 2:
+            raise CommandError("fatal: no repository given")
+        path, name = self.repo_path(argv[1])
+        if not os.path.isdir(path):
+            raise CommandError("fatal: '%s': not found" % name)
+        receive = argv[0] == 'git-receive-pack'
+        before = self._refs(path) if receive else None
+        p = subprocess.Popen([argv[0], path], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def _pump_in():
+            try:
+                while True:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    p.stdin.write(data)
+                    p.stdin.flush()
+            except (IOError, OSError, socket.error):
+                pass
+            finally:
+                try:
+                    p.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        def _pump_err():
+            for data in iter(lambda: os.read(p.stderr.fileno(), 65536), b''):
+                channel.sendall_stderr(data)
+
+        threads = [threading.Thread(target=_pump_in),
+                   threading.Thread(target=_pump_err)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for data in iter(lambda: os.read(p.stdout.fileno(), 65536), b''):
+            channel.sendall(data)
+        rc = p.wait()
+        threads[1].join()
+        if receive:
+            after = self._refs(path)
+            for ref in sorted(set(before) | set(after)):
+                if before.get(ref) != after.get(ref):
+                    self.emit(dict(
+                        type='ref-updated',
+                        submitter=dict(username='fake'),
+                        refUpdate=dict(project=name, refName=ref,
+                                       oldRev=before.get(ref, '0' * 40),
+                                       newRev=after.get(ref, '0' * 40))))
+        return rc
+
+    def _commit_tree(self, path, entries, message, parent=None):
+        tree_input = ''.join('100644 blob %s\t%s\n' % (
+            self._git_output(path, 'hash-object', '-w', '--stdin',
+                             data=content.encode('utf-8')), filename)
+            for filename, content in sorted(entries.items()))
+        tree = self._git_output(path, 'mktree',
+                                data=tree_input.encode('utf-8'))
+        args = ['commit-tree', tree, '-m', message]
+        if parent:
+            args.extend(['-p', parent])
+        return self._git_output(path, *args)
+
+    # Commands
+
+    def cmd_version(self, args):
+        return "gerrit version 2.13.0-fake\n"
+
+    def cmd_ls_projects(self, args):
+        show_description = '--description' in args or '-d' in args
+        prefix = None
+        if '--prefix' in args or '-p' in args:
+            flag = '--prefix' if '--prefix' in args else '-p'
+            prefix = args[args.index(flag) + 1]
+        branch = None
+        if '--show-branch' in args or '-b' in args:
+            flag = '--show-branch' if '--show-branch' in args else '-b'
+            branch = args[args.index(flag) + 1]
+        lines = []
+        with self._lock:
+            items = sorted(self.descriptions.items())
+        for name, description in items:
+            if prefix and not name.startswith(prefix):
+                continue
+            if branch:
+                revision = self._branch(name, branch)
+                if revision:
+                    lines.append('%s %s\n' % (revision, name))
+            elif show_description and description:
+                lines.append('%s - %s\n' % (name, description))
+            else:
+                lines.append('%s\n' % name)
+        return ''.join(lines)
+
+    def _branch(self, name, branch):
+        path, name = self.repo_path(name)
+        if not os.path.isdir(path):
+            return None
+        try:
+            return self._git_output(path, 'rev-parse', '--verify', '-q',
+                                    'refs/heads/%s' % branch)
+        except CommandError:
+            return None
+
+    def cmd_create_project(self, args):
+        name = None
+        description = ''
+        empty_commit = False
+        i = 0
+        while i < len(args):
+            if args[i] == '--name':
+                name = args[i + 1]
+                i += 1
+            elif args[i] == '--description':
+                description = args[i + 1]
+                i += 1
+            elif args[i] == '--empty-commit':
+                empty_commit = True
+            elif not args[i].startswith('-'):
+                name = args[i]
+            i += 1
+        if not name:
+            raise CommandError("fatal: project name is required")
+        path, name = self.repo_path(name)
+        with self._lock:
+            if name in self.descriptions:
+                raise CommandError("fatal: Project already exists")
+            self.descriptions[name] = description or None
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+                self._git_output(path, 'init', '--bare', '-q')
+        except Exception:
+            with self._lock:
+                del self.descriptions[name]
+            raise
+        commit = self._commit_tree(
+            path, {'project.config': PROJECT_CONFIG % description},
+            'Created project')
+        self._git_output(path, 'update-ref', 'refs/meta/config', commit)
+        if empty_commit:
+            commit = self._commit_tree(path, {}, 'Initial empty repository')
+            self._git_output(path, 'update-ref', 'refs/heads/master', commit)
+        self.emit(dict(type='project-created', projectName=name,
+                       headName='refs/heads/master'))
+        self.emit(dict(type='ref-updated', submitter=dict(username='fake'),
+                       refUpdate=dict(project=name,
+                                      refName='refs/meta/config',
+                                      oldRev='0' * 40, newRev=commit)))
+        return ''
+
+    def cmd_set_project(self, args):
+        if not args:
+            raise CommandError("fatal: project name is required")
+        path, name = self.repo_path(args[0])
+        with self._lock:
+            if name not in self.descriptions:
+                raise CommandError("fatal: project %s not found" % name)
+            if '--description' in args:
+                self.descriptions[name] = args[
+                    args.index('--description') + 1]
+        return ''
+
+    def cmd_ls_user_refs(self, args):
+        if '-p' not in args:
+            raise CommandError("fatal: --project is required")
+        path, name = self.repo_path(args[args.index('-p') + 1])
+        if not os.path.isdir(path):
+            raise CommandError("fatal: project %s not found" % name)
+        refs = self._refs(path)
+        if '--only-refs-heads' in args:
+            refs = [ref for ref in refs if ref.startswith('refs/heads/')]
+        return ''.join('%s\n' % ref for ref in sorted(refs))
+
+    def cmd_ls_groups(self, args):
+        verbose = '-v' in args or '--verbose' in args
+        queries = [args[i + 1] for i, arg in enumerate(args)
+                   if arg in ('-q', '--query') and i + 1 < len(args)]
+        with self._lock:
+            groups = sorted(self.groups.items())
+        lines = []
+        for name, uuid in groups:
+            if queries and name not in queries:
+                continue
+            if verbose:
+                lines.append('%s\t%s\t\tAdministrators\t%s\ttrue\n' % (
+                    name, uuid, self.groups['Administrators']))
+            else:
+                lines.append('%s\n' % name)
+        return ''.join(lines)
+
+    def cmd_create_group(self, args):
+        names = []
+        i = 0
+        while i < len(args):
+            if args[i] in ('--owner', '-o', '--description', '-d',
+                           '--member', '--group', '-g'):
+                i += 1
+            elif not args[i].startswith('-'):
+                names.append(args[i])
+            i += 1
+        if not names:
+            raise CommandError("fatal: group name is required")
+        name = names[-1]
+        with self._lock:
+            if name in self.groups or name in SYSTEM_GROUPS:
+                raise CommandError("fatal: group '%s' already exists" % name)
+            self.groups[name] = group_uuid(name)
+        return ''
+
+    def cmd_replication(self, args):
+        return ''
+
+    def cmd_plugin(self, args):
+        return '{}\n'
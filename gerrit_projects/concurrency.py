@@ -0,0 +1,144 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Adaptive limit on the number of sessions open against Gerrit.
+
+SSH commands and git processes talking to Gerrit both run on its sshd
+thread pool, which is shared with interactive users.  AdaptiveLimiter
+hands out slots to them and adjusts how many may be open at once with
+AIMD: the limit creeps up by one for every limit's worth of commands that
+finish promptly and is halved when a command is much slower than usual
+for its kind, breaks the transport or is refused for lack of sessions.
+Commands whose duration depends on how much they carry, like git pushes,
+are only judged by their errors and timeouts.
+"""
+
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+# Lower case fragments of errors meaning the server is out of sessions
+OVERLOAD_MARKERS = ('too many concurrent connections', 'too many sessions',
+                    'resource shortage', 'administratively prohibited',
+                    'connection reset', 'unable to open channel')
+# Exceptions meaning the transport itself failed
+TRANSPORT_ERRORS = (EOFError, socket.error)
+
+
+def is_overload(error):
+    """Whether error (an exception or output text) says Gerrit is full."""
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    text = str(error).lower()
+    return any(marker in text for marker in OVERLOAD_MARKERS)
+
+
+class Slot(object):
+    """Handed out by AdaptiveLimiter.slot(), one per command."""
+
+    def __init__(self, name, timed=True):
+        self.name = name
+        self.timed = timed
+        self.start = time.time()
+        self.overloaded = False
+
+    def check(self, output):
+        """Mark the slot overloaded if a failed command's output says so."""
+        if output and is_overload(output):
+            self.overloaded = True
+
+
+class AdaptiveLimiter(object):
+    """AIMD concurrency limit between 1 and ceiling - reserve.
+
+    reserve slots of the ceiling are never used, leaving room for people.
+    A command counts as congested when it takes more than tolerance times
+    the fastest recent run of the same kind, plus slack seconds.
+    """
+    log = logging.getLogger("manage_projects.AdaptiveLimiter")
+
+    def __init__(self, ceiling=8, reserve=0, initial=None, tolerance=3.0,
+                 slack=0.25):
+        self.maximum = max(1, int(ceiling) - int(reserve))
+        if initial is None:
+            initial = self.maximum // 2
+        self.limit = float(min(self.maximum, max(1, initial)))
+        self.tolerance = float(tolerance)
+        self.slack = float(slack)
+        self.in_flight = 0
+        self.backoffs = 0
+        # command name -> latency of its fastest recent run
+        self._baseline = {}
+        self._last_backoff = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, slot):
+        latency = time.time() - slot.start
+        with self._cond:
+            self.in_flight -= 1
+            if slot.overloaded or (slot.timed and
+                                   self._congested(slot.name, latency)):
+                # Commands started before the last cut saw the old limit;
+                # only back off once for them.
+                if slot.start > self._last_backoff:
+                    self._last_backoff = time.time()
+                    self.backoffs += 1
+                    self.limit = max(1.0, self.limit / 2)
+                    self.log.debug("%s %s after %.3fs, concurrency limit "
+                                   "now %d" % (
+                                       slot.name, 'overloaded'
+                                       if slot.overloaded else 'slow',
+                                       latency, self.limit))
+            elif self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _congested(self, name, latency):
+        baseline = self._baseline.get(name)
+        if baseline is None or latency < baseline:
+            self._baseline[name] = latency
+            return False
+        # Let the baseline drift up slowly so that a server which got
+        # slower for good is not treated as congested forever.
+        self._baseline[name] = baseline + (latency - baseline) * 0.05
+        return latency > baseline * self.tolerance + self.slack
+
+    @contextlib.contextmanager
+    def slot(self, name, timed=True):
+        """Run the body in a slot, backing off if it fails with overload.
+
+        Unless timed, how long the body took does not count as congestion.
+        """
+        self.acquire()
+        slot = Slot(name, timed)
+        try:
+            yield slot
+        except Exception as e:
+            if is_overload(e):
+                slot.overloaded = True
+            raise
+        finally:
+            self.release(slot)
+
+
+@contextlib.contextmanager
+def unlimited(name, timed=True):
+    """Stand-in for AdaptiveLimiter.slot() when nothing is limited."""
+    yield Slot(name, timed)
@@ -0,0 +1,166 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Run subprocesses from many threads with bounded output and time.
+
+Every command gets its own environment and its own process group, so
+that one which outlives its timeout can be killed together with the
+ssh or git helpers it started.  Output (stdout and stderr together) is
+read as it is produced and at most max_output bytes of it are kept.
+"""
+
+import collections
+import errno
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# Bytes of output kept per command
+MAX_OUTPUT = 8 * 1024 * 1024
+# Seconds between SIGTERM and SIGKILL for a command that timed out
+KILL_GRACE = 2.0
+
+# output holds at most max_output bytes; truncated says whether more was
+# produced.  wall and cpu are in seconds, cpu counting user and system
+# time of the command and the children it waited for.
+Result = collections.namedtuple(
+    'Result', 'returncode output truncated timed_out wall cpu')
+
+if sys.version_info[0] >= 3:
+    _NEW_SESSION = dict(start_new_session=True)
+else:
+    _NEW_SESSION = dict(preexec_fn=os.setsid)
+
+
+def _feed(stdin, data):
+    try:
+        stdin.write(data)
+    except (IOError, OSError):
+        # The command exited without reading everything
+        pass
+    finally:
+        try:
+            stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+def _returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _wait(pid, timeout=None):
+    """Reap pid; return (status, rusage), or None if timeout passed."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            if deadline is None:
+                _, status, usage = os.wait4(pid, 0)
+                return (status, usage)
+            reaped, status, usage = os.wait4(pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if reaped:
+            return (status, usage)
+        if time.time() >= deadline:
+            return None
+        time.sleep(0.05)
+
+
+def _kill_group(pid):
+    """SIGTERM the process group of pid, SIGKILL it if it lingers."""
+    for sig, grace in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, None)):
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            pass
+        reaped = _wait(pid, grace)
+        if reaped is not None:
+            return reaped
+
+
+def run(argv, env=None, data=None, timeout=None, max_output=MAX_OUTPUT):
+    """Run argv and return a Result once it exits or timeout passed.
+
+    env is the complete environment of the command; data, if given, is
+    written to its stdin.
+    """
+    start = time.time()
+    deadline = None if timeout is None else start + timeout
+    # close_fds keeps commands started concurrently by other threads
+    # from holding on to this command's pipes.
+    p = subprocess.Popen(
+        argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+        stdin=subprocess.PIPE if data is not None else None,
+        close_fds=True, **_NEW_SESSION)
+    writer = None
+    if data is not None:
+        writer = threading.Thread(target=_feed, args=(p.stdin, data))
+        writer.daemon = True
+        writer.start()
+
+    chunks = []
+    kept = 0
+    truncated = False
+    timed_out = False
+    fd = p.stdout.fileno()
+    poll = select.poll()
+    poll.register(fd, select.POLLIN | select.POLLHUP)
+    while True:
+        wait = None
+        if deadline is not None:
+            wait = deadline - time.time()
+            if wait <= 0:
+                timed_out = True
+                break
+            wait = int(wait * 1000) + 1
+        try:
+            if not poll.poll(wait):
+                continue
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        keep = chunk[:max(0, max_output - kept)]
+        if keep:
+            chunks.append(keep)
+            kept += len(keep)
+        if len(keep) < len(chunk):
+            truncated = True
+
+    reaped = None
+    if not timed_out:
+        # The command may close its output and keep running
+        reaped = _wait(p.pid, None if deadline is None
+                       else max(0.0, deadline - time.time()))
+        timed_out = reaped is None
+    if timed_out:
+        reaped = _kill_group(p.pid)
+    status, usage = reaped
+    # Tell Popen the process is gone so that it does not wait for it
+    p.returncode = _returncode(status)
+    p.stdout.close()
+    if writer is not None:
+        writer.join()
+    return Result(p.returncode, b''.join(chunks), truncated, timed_out,
+                  time.time() - start, usage.ru_utime + usage.ru_stime)
@@ -13,15 +13,27 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import collections
 import json
 import logging
+import os
 import pprint
 import select
-import six.moves
+import socket
+import tempfile
 import threading
 import time
 
 import paramiko
+import six
+
+from multiprocessing.pool import ThreadPool
+from six.moves import http_client
+
+import gerrit_projects.concurrency as concurrency
+import gerrit_projects.metrics as metrics
+import gerrit_projects.retry as retry
 
 CONNECTED = 'connected'
 CONNECTING = 'connecting'
@@ -36,6 +48,139 @@ UPDATE_ALLOWED_KEYS = ['description', 'submit-type',
                        'max-object-size-limit']
 GERRIT_SYSTEM_GROUPS= ['Anonymous Users', 'Change Owner',
                        'Project Owners', 'Registered Users']
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL]
+# Gerrit prefixes JSON responses with this to defeat XSSI
+XSSI_PREFIX = b")]}'"
+# set-project option -> field of the REST API's ConfigInput
+REST_CONFIG_KEYS = {'submit-type': 'submit_type',
+                    'contributor-agreements': 'use_contributor_agreements',
+                    'signed-off-by': 'use_signed_off_by',
+                    'content-merge': 'use_content_merge',
+                    'change-id': 'require_change_id',
+                    'project-state': 'state',
+                    'max-object-size-limit': 'max_object_size_limit'}
+# Keys whose REST values are enum constants, e.g. read-only -> READ_ONLY
+REST_ENUM_KEYS = ('submit-type', 'project-state')
+
+# Starting an SSH command again is safe: it never reached the server
+SSH_RETRY = retry.RetryPolicy(initial=0.01, maximum=1.0, attempts=4,
+                              timeout=10)
+
+# Outcome of one command run by Gerrit.run_many(); error is the exception
+# it raised, in which case out and err are None.
+CommandResult = collections.namedtuple('CommandResult',
+                                       'command out err error')
+
+
+class EventQueue(object):
+    """A FIFO of Gerrit events holding at most maxsize in memory.
+
+    When full, put() either blocks, drops the oldest event or spills new
+    events to a temporary file in spill_dir, depending on overflow.
+    Spilled events are read back in order as the queue drains.
+    """
+    log = logging.getLogger("gerrit.EventQueue")
+
+    def __init__(self, maxsize=0, overflow=OVERFLOW_BLOCK, spill_dir=None):
+        assert overflow in OVERFLOW_POLICIES, \
+            "Overflow policy must be one of %s" % OVERFLOW_POLICIES
+        self.maxsize = int(maxsize)
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.dropped = 0
+        self._events = collections.deque()
+        self._cond = threading.Condition()
+        self._spill = None
+        self._spilled = 0
+        self._spill_read = 0
+
+    def _full(self):
+        return self.maxsize > 0 and len(self._events) >= self.maxsize
+
+    def __len__(self):
+        with self._cond:
+            return len(self._events) + self._spilled
+
+    def _spill_event(self, event):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(mode='w+b',
+                                                 dir=self.spill_dir)
+            self._spill_read = 0
+        self._spill.seek(0, os.SEEK_END)
+        self._spill.write(json.dumps(event).encode('utf-8') + b'\n')
+        self._spilled += 1
+
+    def _refill(self):
+        if not self._spilled:
+            return
+        self._spill.seek(self._spill_read)
+        while self._spilled and not self._full():
+            self._events.append(json.loads(
+                self._spill.readline().decode('utf-8')))
+            self._spilled -= 1
+        self._spill_read = self._spill.tell()
+        if not self._spilled:
+            self._spill.close()
+            self._spill = None
+
+    def put(self, event):
+        with self._cond:
+            if self._spilled or self._full():
+                if self.overflow == OVERFLOW_SPILL:
+                    # Once spilling, keep spilling so order is preserved.
+                    self._spill_event(event)
+                    self._cond.notify_all()
+                    return
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    self._events.popleft()
+                    self.dropped += 1
+                    if self.dropped % 1000 == 1:
+                        self.log.warning("Event queue full, %s events "
+                                         "dropped so far" % self.dropped)
+                else:
+                    while self._full():
+                        self._cond.wait()
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def get_batch(self, max_n=1, timeout=None):
+        """Return up to max_n events, waiting up to timeout for the first.
+
+        With timeout=None this blocks until at least one event arrives;
+        on timeout an empty list is returned.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._refill()
+            while not self._events:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return []
+                    self._cond.wait(remaining)
+                self._refill()
+            batch = []
+            while self._events and len(batch) < max_n:
+                batch.append(self._events.popleft())
+                if not self._events:
+                    self._refill()
+            self._refill()
+            self._cond.notify_all()
+            return batch
+
+    def get(self):
+        return self.get_batch(1)[0]
+
+
+def _reconnectable(error):
+    """Whether connecting again might get past error."""
+    return not isinstance(error, (paramiko.AuthenticationException,
+                                  paramiko.BadHostKeyException))
 
 
 class GerritWatcher(threading.Thread):
@@ -60,58 +205,59 @@ class GerritWatcher(threading.Thread):
         self.gerrit = gerrit
         self.connection_attempts = int(connection_attempts)
         self.retry_delay = float(retry_delay)
+        # Back off from milliseconds up to retry_delay; the event stream
+        # outlives any run deadline.
+        self.retry = retry.RetryPolicy(
+            initial=min(0.05, self.retry_delay), maximum=self.retry_delay,
+            attempts=max(0, self.connection_attempts),
+            retryable=_reconnectable, run_deadline=False)
+        self._failures = 0
         self.state = IDLE
 
-    def _read(self, fd):
-        l = fd.readline()
-        data = json.loads(l)
-        self.log.debug("Received data from Gerrit event stream: \n%s" %
-                       pprint.pformat(data))
-        self.gerrit.addEvent(data)
+    def _read(self, channel, buf):
+        """Read what is available and queue every complete event.
+
+        Returns the trailing partial line, or None at end of stream.
+        """
+        chunk = channel.recv(65536)
+        if not chunk:
+            return None
+        lines = (buf + chunk).split(b'\n')
+        for l in lines[:-1]:
+            if not l.strip():
+                continue
+            data = json.loads(l.decode('utf-8'))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("Received data from Gerrit event stream: \n%s" %
+                               pprint.pformat(data))
+            self.gerrit.addEvent(data)
+        return lines[-1]
 
     def _listen(self, stdout, stderr):
         poll = select.poll()
         poll.register(stdout.channel)
+        buf = b''
         while True:
             ret = poll.poll()
             for (fd, event) in ret:
                 if fd == stdout.channel.fileno():
-                    if event == select.POLLIN:
-                        self._read(stdout)
+                    if event & select.POLLIN:
+                        buf = self._read(stdout.channel, buf)
+                        if buf is None:
+                            return
                     else:
                         raise Exception("event on ssh connection")
 
     def _connect(self):
         """Attempts to connect and returns the connected client."""
-
-        def _make_client():
+        failures = 0
+        while True:
+            self.log.debug("Connection attempt %s to %s:%s",
+                           failures + 1, self.hostname, self.port)
             client = paramiko.SSHClient()
             client.load_system_host_keys()
             client.set_missing_host_key_policy(paramiko.WarningPolicy())
-            return client
-
-        def _attempt_gen(connection_attempts, retry_delay):
-            if connection_attempts <= 0:
-                attempt = 1
-                while True:
-                    yield (attempt, retry_delay)
-                    attempt += 1
-            else:
-                for attempt in range(1, connection_attempts + 1):
-                    if attempt < connection_attempts:
-                        yield (attempt, retry_delay)
-                    else:
-                        # No more attempts left after this one, (signal this by
-                        # not returning a valid retry_delay).
-                        yield (attempt, None)
-
-        for (attempt, retry_delay) in _attempt_gen(self.connection_attempts,
-                                                   self.retry_delay):
-            self.log.debug("Connection attempt %s to %s:%s (retry_delay=%s)",
-                           attempt, self.hostname, self.port, retry_delay)
-            client = None
             try:
-                client = _make_client()
                 client.connect(self.hostname,
                                username=self.username,
                                port=self.port,
@@ -120,18 +266,14 @@ class GerritWatcher(threading.Thread):
             except (IOError, paramiko.SSHException) as e:
                 self.log.exception("Exception connecting to %s:%s",
                                    self.hostname, self.port)
-                if client:
-                    try:
-                        client.close()
-                    except (IOError, paramiko.SSHException):
-                        self.log.exception("Failure closing broken client")
-                if retry_delay is not None:
-                    if retry_delay > 0:
-                        self.log.info("Trying again in %s seconds",
-                                      retry_delay)
-                        time.sleep(retry_delay)
-                else:
-                    raise e
+                try:
+                    client.close()
+                except (IOError, paramiko.SSHException):
+                    self.log.exception("Failure closing client")
+                failures += 1
+                if (not self.retry.retryable(e) or
+                        not self.retry.backoff(failures)):
+                    raise
 
     def _consume(self, client):
         """Consumes events using the given client."""
@@ -151,21 +293,29 @@ class GerritWatcher(threading.Thread):
         self.state = CONNECTING
         client = self._connect()
         self.state = CONNECTED
+        started = time.time()
         try:
             self._consume(client)
+            self.log.info("Gerrit event stream ended")
         except Exception:
             # NOTE(harlowja): allow consuming failures to *always* be retryable
             self.log.exception("Exception consuming ssh event stream:")
-            if client:
-                try:
-                    client.close()
-                except (IOError, paramiko.SSHException):
-                    self.log.exception("Failure closing broken client")
-            self.state = DISCONNECTED
-            if self.retry_delay > 0:
-                self.log.info("Delaying consumption retry for %s seconds",
-                              self.retry_delay)
-                time.sleep(self.retry_delay)
+        if client:
+            try:
+                client.close()
+            except (IOError, paramiko.SSHException):
+                self.log.exception("Failure closing client")
+        self.state = DISCONNECTED
+        # A stream that ends cleanly (e.g. sshd restarting) is reconnected
+        # to with the same backoff, which only grows while the stream keeps
+        # ending soon after connecting.
+        if time.time() - started > self.retry.maximum:
+            self._failures = 0
+        self._failures += 1
+        delay = self.retry.delay(self._failures)
+        self.log.info("Delaying consumption retry for %.3f seconds",
+                      delay)
+        time.sleep(delay)
 
     def run(self):
         try:
@@ -176,20 +326,259 @@ class GerritWatcher(threading.Thread):
             self.state = DEAD
 
 
+def system_group_uuid(group):
+    return 'global:%s' % group.replace(' ', '-')
+
+
+class GroupIndex(object):
+    """Map group names to UUIDs using a single ls-groups call.
+
+    The index is loaded lazily, kept up to date as groups are created and
+    can optionally be persisted to cache_file for ttl seconds.  A group
+    missing from an index just listed from the server does not exist; only
+    a cached index, or a group created since, makes get() ask the server.
+    """
+    log = logging.getLogger("gerrit.GroupIndex")
+
+    def __init__(self, gerrit, cache_file=None, ttl=0):
+        self.gerrit = gerrit
+        self.cache_file = cache_file
+        self.ttl = float(ttl)
+        self._groups = None
+        # Whether _groups came from the server rather than cache_file
+        self._fresh = False
+        # Groups created since the index was loaded, UUIDs still unknown
+        self._created = set()
+        self._lock = threading.Lock()
+
+    def _read_cache(self):
+        if not self.cache_file or self.ttl <= 0:
+            return None
+        try:
+            with open(self.cache_file) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if time.time() - data.get('timestamp', 0) > self.ttl:
+            self.log.debug("Group cache %s expired" % self.cache_file)
+            return None
+        return data.get('groups')
+
+    def _write_cache(self):
+        if not self.cache_file or self.ttl <= 0:
+            return
+        tmpname = '%s.tmp' % self.cache_file
+        try:
+            with open(tmpname, 'w') as fp:
+                json.dump(dict(timestamp=time.time(), groups=self._groups),
+                          fp)
+            os.rename(tmpname, self.cache_file)
+        except (IOError, OSError):
+            self.log.exception("Failure writing group cache %s" %
+                               self.cache_file)
+
+    def _load(self, use_cache=True):
+        if self._groups is not None:
+            return
+        groups = self._read_cache() if use_cache else None
+        if groups is None:
+            groups = {}
+            for line in self.gerrit.listGroups(verbose=True):
+                fields = line.split('\t')
+                if len(fields) > 1:
+                    groups[fields[0]] = fields[1]
+            self._groups = groups
+            self._fresh = True
+            self._write_cache()
+        else:
+            self._groups = groups
+            self._fresh = False
+
+    def refresh(self):
+        with self._lock:
+            self._groups = None
+            self._load(use_cache=False)
+
+    def add(self, group, uuid):
+        with self._lock:
+            self._load()
+            self._groups[group] = uuid
+            self._created.discard(group)
+            self._write_cache()
+
+    def created(self, group):
+        """Note that group was created without learning its UUID."""
+        with self._lock:
+            self._created.add(group)
+
+    def get(self, group):
+        if group in GERRIT_SYSTEM_GROUPS:
+            return system_group_uuid(group)
+        with self._lock:
+            self._load()
+            uuid = self._groups.get(group)
+            ask = uuid is None and (not self._fresh or
+                                    group in self._created)
+        if ask:
+            # A cached index may be older than the group, and create-group
+            # does not tell the UUID, so ask the server about this one.
+            uuid = self.gerrit._queryGroupUUID(group)
+            if uuid:
+                self.add(group, uuid)
+        return uuid
+
+
 class Gerrit(object):
     log = logging.getLogger("gerrit.Gerrit")
 
-    def __init__(self, hostname, username, port=29418, keyfile=None):
+    def __init__(self, hostname, username, port=29418, keyfile=None,
+                 pool_size=1, keepalive=30, max_in_flight=8, limiter=None):
+        """Create a Gerrit.
+
+        SSH connections are opened lazily and kept for the life of the
+        object; every command runs in its own channel on one of
+        ``pool_size`` long-lived transports.  Commands started with
+        submit() or run_many() overlap, at most ``max_in_flight`` at a
+        time.  With a concurrency.AdaptiveLimiter as ``limiter`` every
+        command also waits for one of its slots.  Call close() when done.
+        """
+        assert pool_size >= 1, "Pool size must be >= 1"
+        assert max_in_flight >= 1, "In-flight limit must be >= 1"
         self.username = username
         self.hostname = hostname
         self.port = port
         self.keyfile = keyfile
+        self.pool_size = int(pool_size)
+        self.keepalive = int(keepalive)
         self.watcher_thread = None
         self.event_queue = None
         self.installed_plugins = None
+        self.group_index = None
+        self._clients = []
+        self._next_client = 0
+        self._clients_lock = threading.Lock()
+        self.max_in_flight = int(max_in_flight)
+        self._executor = None
+        self.limiter = limiter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Wait for submitted commands, then close every SSH connection."""
+        with self._clients_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.close()
+            executor.join()
+        with self._clients_lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            self._close_client(client)
+
+    def _close_client(self, client):
+        try:
+            client.close()
+        except (IOError, paramiko.SSHException):
+            self.log.exception("Failure closing SSH client")
+
+    def _make_client(self):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        self.log.debug("Opening SSH connection to %s:%s" %
+                       (self.hostname, self.port))
+        client.connect(self.hostname,
+                       username=self.username,
+                       port=self.port,
+                       key_filename=self.keyfile)
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        return client
 
-    def startWatching(self, connection_attempts=-1, retry_delay=5):
-        self.event_queue = six.moves.queue.Queue()
+    @staticmethod
+    def _client_active(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _get_client(self):
+        """Return a live pooled client, (re)connecting as needed."""
+        with self._clients_lock:
+            if len(self._clients) < self.pool_size:
+                client = self._make_client()
+                self._clients.append(client)
+                return client
+            index = self._next_client % len(self._clients)
+            self._next_client = index + 1
+            client = self._clients[index]
+            if not self._client_active(client):
+                self.log.debug("SSH connection to %s:%s dropped, "
+                               "reconnecting" % (self.hostname, self.port))
+                self._close_client(client)
+                client = self._make_client()
+                self._clients[index] = client
+            return client
+
+    def _discard_client(self, client):
+        with self._clients_lock:
+            if client in self._clients:
+                self._clients.remove(client)
+        self._close_client(client)
+
+    def _submit(self, func, *args):
+        with self._clients_lock:
+            if self._executor is None:
+                self._executor = ThreadPool(self.max_in_flight)
+            executor = self._executor
+        return executor.apply_async(func, args)
+
+    @staticmethod
+    def _wait(futures):
+        """Return a (value, exception) pair for each future, in order."""
+        results = []
+        for future in futures:
+            try:
+                results.append((future.get(), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    def submit(self, command, careaboutexitcode=True):
+        """Start command in the background and return its future.
+
+        The command runs in its own channel on a pooled transport, so
+        several can be in flight on one connection.  The returned
+        AsyncResult's get() gives (out, err) or raises like _ssh().
+        Do not wait on it from a function that was itself submitted.
+        """
+        return self._submit(self._ssh, command, careaboutexitcode)
+
+    def run_many(self, commands, careaboutexitcode=True):
+        """Run commands concurrently and return their CommandResults.
+
+        Results are in the order of commands; one failing command does
+        not stop the others.
+        """
+        commands = list(commands)
+        futures = [self.submit(command, careaboutexitcode)
+                   for command in commands]
+        results = []
+        for command, (value, error) in zip(commands, self._wait(futures)):
+            out, err = value or (None, None)
+            results.append(CommandResult(command, out, err, error))
+        return results
+
+    def startWatching(self, connection_attempts=-1, retry_delay=5,
+                      queue_size=0, overflow=OVERFLOW_BLOCK, spill_dir=None):
+        """Start a GerritWatcher feeding a bounded EventQueue.
+
+        queue_size limits the events held in memory (0 is unbounded) and
+        overflow picks what happens when it is reached.
+        """
+        self.event_queue = EventQueue(queue_size, overflow, spill_dir)
         watcher = GerritWatcher(self,
                                 connection_attempts=connection_attempts,
                                 retry_delay=retry_delay)
@@ -203,6 +592,15 @@ class Gerrit(object):
     def getEvent(self):
         return self.event_queue.get()
 
+    def getEvents(self, max_n=100, timeout=None):
+        """Return up to max_n queued events, see EventQueue.get_batch."""
+        return self.event_queue.get_batch(max_n, timeout)
+
+    def useGroupIndex(self, cache_file=None, ttl=0):
+        """Resolve group UUIDs through a shared GroupIndex."""
+        self.group_index = GroupIndex(self, cache_file, ttl)
+        return self.group_index
+
     def createGroup(self, group, visible_to_all=True, owner=None):
         cmd = 'gerrit create-group'
         if visible_to_all:
@@ -211,6 +609,8 @@ class Gerrit(object):
             cmd = '%s --owner %s' % (cmd, owner)
         cmd = '%s "%s"' % (cmd, group)
         out, err = self._ssh(cmd)
+        if self.group_index:
+            self.group_index.created(group)
         return err
 
     def createProject(self, project, require_change_id=True, empty_repo=False,
@@ -241,15 +641,34 @@ class Gerrit(object):
         out, err = self._ssh(cmd)
         return err
 
-    def listProjects(self, show_description=False):
+    def listProjects(self, show_description=False, prefix=None):
         cmd = 'gerrit ls-projects --type ALL'
         if show_description:
             # display projects alongs with descriptions
             # separated by ' - ' sequence
             cmd += ' --description'
+        if prefix:
+            # only projects whose name starts with prefix
+            cmd += ' --prefix %s' % prefix
         out, err = self._ssh(cmd)
         return filter(None, out.split('\n'))
 
+    def listBranchHeads(self, branch, prefix=None):
+        """Map every project having branch to the branch's revision.
+
+        One ls-projects call covers all projects (starting with prefix).
+        """
+        cmd = 'gerrit ls-projects --type ALL --show-branch %s' % branch
+        if prefix:
+            cmd += ' --prefix %s' % prefix
+        out, err = self._ssh(cmd)
+        heads = {}
+        for line in filter(None, out.split('\n')):
+            # '<sha> <name>' for each project that has the branch
+            revision, _, name = line.partition(' ')
+            heads[name.strip()] = revision
+        return heads
+
     def listProjectRefs(self, project):
         cmd = 'gerrit ls-user-refs -p %s -u %s --only-refs-heads' % (project, self.username)
         out, err = self._ssh(cmd)
@@ -264,9 +683,36 @@ class Gerrit(object):
         return filter(None, out.split('\n'))
 
     def getGroupUUID(self, group):
+        if self.group_index:
+            return self.group_index.get(group)
         if group in GERRIT_SYSTEM_GROUPS:
-            return 'global:%s' % group.replace(' ', '-')
+            return system_group_uuid(group)
+        return self._queryGroupUUID(group)
+
+    def createGroups(self, groups, visible_to_all=True, owner=None):
+        """Create groups concurrently.
+
+        Returns a dict of group -> the exception creating it raised, or
+        None if it was created.
+        """
+        groups = list(groups)
+        futures = [self._submit(self.createGroup, group, visible_to_all,
+                                owner) for group in groups]
+        return dict((group, error) for group, (_, error)
+                    in zip(groups, self._wait(futures)))
+
+    def getGroupUUIDs(self, groups):
+        """Resolve groups concurrently to a dict of group -> UUID or None."""
+        groups = list(groups)
+        futures = [self._submit(self.getGroupUUID, group) for group in groups]
+        uuids = {}
+        for group, (uuid, error) in zip(groups, self._wait(futures)):
+            if error is not None:
+                raise error
+            uuids[group] = uuid
+        return uuids
 
+    def _queryGroupUUID(self, group):
         cmd = 'gerrit ls-groups -v -q "%s"' % group
         out, err = self._ssh(cmd, False)
         if out:
@@ -337,45 +783,377 @@ class Gerrit(object):
         return data
 
     def bulk_query(self, query):
-        cmd = 'gerrit query --format json %s"' % (
-            query)
-        out, err = self._ssh(cmd)
-        if not out:
-            return False
-        lines = out.split('\n')
-        if not lines:
-            return False
+        """Return every change matching query as a list, or False.
 
-        data = []
-        for line in lines:
-            if line:
-                data.append(json.loads(line))
+        The trailing stats row is not included; use iter_query() to avoid
+        holding all results in memory.
+        """
+        data = list(self.iter_query('%s"' % query))
         if not data:
             return False
-        self.log.debug("Received data from Gerrit query: \n%s" % (
-            pprint.pformat(data)))
         return data
 
-    def _ssh(self, command, careaboutexitcode=True):
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        client.connect(self.hostname,
-                       username=self.username,
-                       port=self.port,
-                       key_filename=self.keyfile)
+    def iter_query(self, query):
+        """Yield each change matching query as it arrives.
 
+        Gerrit's result limit is followed transparently: with --start on
+        servers that report moreChanges, and with resume_sortkey: on
+        older servers that only return a sortKey per change.
+        """
+        start = 0
+        resume = None
+        while True:
+            cmd = 'gerrit query --format json %s' % query
+            if resume:
+                cmd += ' resume_sortkey:%s' % resume
+            elif start:
+                cmd += ' --start %d' % start
+            stats = None
+            last = None
+            rows = 0
+            for line in self._ssh_lines(cmd):
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if data.get('type') == 'stats':
+                    stats = data
+                    continue
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug("Received data from Gerrit query: \n%s" %
+                                   pprint.pformat(data))
+                rows += 1
+                last = data
+                yield data
+            if not rows or stats is None:
+                return
+            if 'moreChanges' in stats:
+                if not stats['moreChanges']:
+                    return
+                start += rows
+            elif last.get('sortKey'):
+                resume = last['sortKey']
+            else:
+                return
+
+    def _slot(self, name):
+        if self.limiter is None:
+            return concurrency.unlimited(name)
+        return self.limiter.slot(name)
+
+    def _start(self, command, slot):
+        client = self._get_client()
+        try:
+            return client.exec_command(command)
+        except (EOFError, socket.error, paramiko.SSHException) as e:
+            # The transport went away between commands; drop it so the
+            # next attempt opens a fresh one.
+            self.log.debug("Failed to open SSH channel: %s" % e)
+            slot.check(e)
+            self._discard_client(client)
+            raise
+
+    def _exec(self, command, slot):
+        return SSH_RETRY.call(self._start, command, slot)
+
+    def _ssh_lines(self, command, careaboutexitcode=True):
+        """Run command, yielding stdout line by line as it arrives."""
         self.log.debug("SSH command:\n%s" % command)
-        stdin, stdout, stderr = client.exec_command(command)
+        name = metrics.command_name(command.split())
+        with metrics.REGISTRY.timer(metrics.SSH, name) as timer:
+            # Only starting the command takes a slot: the caller may send
+            # other commands while it consumes the output.
+            with self._slot('%s (start)' % name) as slot:
+                stdin, stdout, stderr = self._exec(command, slot)
+
+            try:
+                for line in stdout:
+                    if isinstance(line, bytes):
+                        line = line.decode('utf-8', 'replace')
+                    yield line
 
-        out = stdout.read()
-        self.log.debug("SSH received stdout:\n%s" % out)
+                ret = timer.status = stdout.channel.recv_exit_status()
+                self.log.debug("SSH exit status: %s" % ret)
 
-        ret = stdout.channel.recv_exit_status()
-        self.log.debug("SSH exit status: %s" % ret)
+                err = stderr.read()
+                self.log.debug("SSH received stderr:\n%s" % err)
+            finally:
+                stdout.channel.close()
+        if ret and careaboutexitcode:
+            raise Exception("Gerrit error executing %s" % command)
+
+    def _ssh(self, command, careaboutexitcode=True):
+        self.log.debug("SSH command:\n%s" % command)
+        name = metrics.command_name(command.split())
+        with self._slot(name) as slot:
+            with metrics.REGISTRY.timer(metrics.SSH, name) as timer:
+                stdin, stdout, stderr = self._exec(command, slot)
+
+                try:
+                    out = stdout.read()
+                    self.log.debug("SSH received stdout:\n%s" % out)
+
+                    ret = timer.status = stdout.channel.recv_exit_status()
+                    self.log.debug("SSH exit status: %s" % ret)
 
-        err = stderr.read()
-        self.log.debug("SSH received stderr:\n%s" % err)
+                    err = stderr.read()
+                    self.log.debug("SSH received stderr:\n%s" % err)
+                finally:
+                    stdout.channel.close()
+            if ret:
+                slot.check(err)
         if ret and careaboutexitcode:
             raise Exception("Gerrit error executing %s" % command)
         return (out, err)
+
+
+class GerritRESTError(Exception):
+    def __init__(self, method, path, status, body):
+        super(GerritRESTError, self).__init__(
+            "Gerrit error executing %s %s: %s %s" % (
+                method, path, status, body.decode('utf-8', 'replace').strip()))
+        self.status = status
+
+
+class HTTPConnectionPool(object):
+    """Keep-alive HTTP(S) connections to one server, shared by threads.
+
+    At most maxsize connections are open at a time; further callers wait
+    for one to become idle.
+    """
+    log = logging.getLogger("gerrit.HTTPConnectionPool")
+
+    def __init__(self, url, maxsize=4, timeout=30):
+        parts = six.moves.urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._idle = six.moves.queue.LifoQueue()
+        self._slots = threading.Semaphore(int(maxsize))
+
+    def _connect(self):
+        if self.scheme == 'https':
+            connection_class = http_client.HTTPSConnection
+        else:
+            connection_class = http_client.HTTPConnection
+        self.log.debug("Opening HTTP connection to %s:%s" %
+                       (self.host, self.port))
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, self.base_path + path, body, headers)
+        response = conn.getresponse()
+        return response.status, response.read(), response.will_close
+
+    def request(self, method, path, body=None, headers=None):
+        """Return (status, body) of a request sent on a pooled connection."""
+        headers = headers or {}
+        with self._slots:
+            try:
+                conn, reused = self._idle.get_nowait(), True
+            except six.moves.queue.Empty:
+                conn, reused = self._connect(), False
+            try:
+                status, data, will_close = self._send(conn, method, path,
+                                                      body, headers)
+            except (socket.error, http_client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped the idle connection; one retry on a
+                # fresh one.
+                self.log.debug("HTTP connection went stale, reconnecting")
+                conn = self._connect()
+                try:
+                    status, data, will_close = self._send(conn, method, path,
+                                                          body, headers)
+                except (socket.error, http_client.HTTPException):
+                    conn.close()
+                    raise
+            if will_close:
+                conn.close()
+            else:
+                self._idle.put(conn)
+            return status, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except six.moves.queue.Empty:
+                return
+
+
+def _quote(name):
+    return six.moves.urllib.parse.quote(name, safe='')
+
+
+class GerritREST(Gerrit):
+    """A Gerrit that uses the REST API where it can.
+
+    Projects, groups, branches, descriptions, plugins and the version are
+    read and written as JSON over pooled keep-alive HTTP connections.
+    Everything else (stream-events, queries, reviews, replication) is
+    inherited from the SSH implementation, whose connections are still
+    only opened when first needed.
+    """
+    log = logging.getLogger("gerrit.GerritREST")
+
+    def __init__(self, hostname, username, port=29418, keyfile=None,
+                 pool_size=1, keepalive=30, url=None, http_username=None,
+                 http_password=None, http_pool_size=4, timeout=30,
+                 max_in_flight=8, limiter=None):
+        super(GerritREST, self).__init__(hostname, username, port, keyfile,
+                                         pool_size, keepalive, max_in_flight,
+                                         limiter)
+        self.url = url or 'https://%s' % hostname
+        self.http = HTTPConnectionPool(self.url, http_pool_size, timeout)
+        self._headers = {'Accept': 'application/json'}
+        self._prefix = ''
+        if http_password:
+            credentials = '%s:%s' % (http_username or username, http_password)
+            self._headers['Authorization'] = 'Basic %s' % base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+            # authenticated REST endpoints live under /a/
+            self._prefix = '/a'
+
+    def close(self):
+        super(GerritREST, self).close()
+        self.http.close()
+
+    def _rest(self, method, path, label, data=None, missing_ok=False):
+        """Send a request and return its decoded JSON response.
+
+        label names the endpoint in metrics.  A 404 returns None if
+        missing_ok, any other error raises GerritRESTError.
+        """
+        headers = dict(self._headers)
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json; charset=UTF-8'
+        self.log.debug("REST request: %s %s" % (method, path))
+        with metrics.REGISTRY.timer(metrics.HTTP,
+                                    '%s %s' % (method, label)) as timer:
+            status, out = self.http.request(method, self._prefix + path,
+                                            body, headers)
+            missing = status == 404 and missing_ok
+            timer.status = status if status >= 400 and not missing else 0
+        self.log.debug("REST response: %s" % status)
+        if missing:
+            return None
+        if status >= 400:
+            raise GerritRESTError(method, path, status, out)
+        if out.startswith(XSSI_PREFIX):
+            out = out[len(XSSI_PREFIX):]
+        out = out.strip()
+        if not out:
+            return None
+        return json.loads(out.decode('utf-8'))
+
+    def createGroup(self, group, visible_to_all=True, owner=None):
+        data = dict(visible_to_all=visible_to_all)
+        if owner:
+            data['owner_id'] = owner
+        info = self._rest('PUT', '/groups/%s' % _quote(group), 'groups',
+                          data)
+        if self.group_index and info and info.get('id'):
+            self.group_index.add(
+                group, six.moves.urllib.parse.unquote(info['id']))
+        return ''
+
+    def createProject(self, project, require_change_id=True, empty_repo=False,
+                      description=None):
+        data = dict(name=project, create_empty_commit=empty_repo)
+        if require_change_id:
+            data['require_change_id'] = 'TRUE'
+        if description:
+            data['description'] = description
+        self._rest('PUT', '/projects/%s' % _quote(project), 'projects', data)
+        return ''
+
+    def updateProject(self, project, update_key, update_value):
+        # check for valid keys
+        if update_key not in UPDATE_ALLOWED_KEYS:
+            raise Exception("Trying to update a non-valid key %s" % update_key)
+
+        if update_key == 'description':
+            self._rest('PUT', '/projects/%s/description' % _quote(project),
+                       'projects/description',
+                       dict(description=update_value))
+            return ''
+        if (update_key in REST_ENUM_KEYS or
+                str(update_value).lower() in ('true', 'false')):
+            # enum constant or InheritableBoolean
+            update_value = str(update_value).upper().replace('-', '_')
+        self._rest('PUT', '/projects/%s/config' % _quote(project),
+                   'projects/config',
+                   {REST_CONFIG_KEYS[update_key]: update_value})
+        return ''
+
+    def listProjects(self, show_description=False, prefix=None):
+        query = 'type=ALL'
+        if show_description:
+            query += '&d'
+        if prefix:
+            query += '&p=%s' % _quote(prefix)
+        projects = self._rest('GET', '/projects/?%s' % query, 'projects')
+        lines = []
+        for name, info in sorted((projects or {}).items()):
+            description = show_description and info.get('description')
+            if description:
+                # same ' - ' separated form as ls-projects --description
+                lines.append('%s - %s' % (name, description))
+            else:
+                lines.append(name)
+        return lines
+
+    def listBranchHeads(self, branch, prefix=None):
+        query = 'type=ALL&b=%s' % _quote(branch)
+        if prefix:
+            query += '&p=%s' % _quote(prefix)
+        projects = self._rest('GET', '/projects/?%s' % query, 'projects')
+        heads = {}
+        for name, info in (projects or {}).items():
+            # like ls-projects --show-branch, skip projects without branch
+            revision = info.get('branches', {}).get(branch)
+            if revision:
+                heads[name] = revision
+        return heads
+
+    def listProjectRefs(self, project):
+        branches = self._rest('GET', '/projects/%s/branches/' %
+                              _quote(project), 'projects/branches')
+        return [branch['ref'] for branch in branches or []
+                if branch['ref'].startswith('refs/heads/')]
+
+    def listGroups(self, verbose=False):
+        groups = self._rest('GET', '/groups/', 'groups') or {}
+        if not verbose:
+            return sorted(groups)
+        lines = []
+        for name, info in sorted(groups.items()):
+            # same tab separated columns as ls-groups -v
+            lines.append('\t'.join([
+                name,
+                six.moves.urllib.parse.unquote(info.get('id', '')),
+                info.get('description') or '',
+                info.get('owner') or '',
+                six.moves.urllib.parse.unquote(info.get('owner_id', '')),
+                str(info.get('options', {}).get(
+                    'visible_to_all', False)).lower()]))
+        return lines
+
+    def _queryGroupUUID(self, group):
+        info = self._rest('GET', '/groups/%s' % _quote(group), 'groups',
+                          missing_ok=True)
+        if info and info.get('id'):
+            return six.moves.urllib.parse.unquote(info['id'])
+        return None
+
+    def getPlugins(self):
+        return self._rest('GET', '/plugins/?all', 'plugins') or {}
+
+    def getVersion(self):
+        return self._rest('GET', '/config/server/version', 'config/version')
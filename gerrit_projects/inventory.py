@@ -0,0 +1,226 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import os
+import threading
+import time
+
+ZERO_REV = '0' * 40
+
+
+def parse_project_descriptions(lines):
+    """Turn 'ls-projects --description' output into name -> description."""
+    projects = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            # Compare equal to the unicode read back from JSON and YAML
+            line = line.decode('utf-8', 'replace')
+        name, _, description = line.partition(' - ')
+        projects[name.strip()] = description.strip() or None
+    return projects
+
+
+class ServerInventory(object):
+    """The projects on the Gerrit server, with descriptions and head refs.
+
+    Everything is kept in dicts, so lookups do not depend on the size of
+    the server.  The inventory is saved as JSON to path; a listing of a
+    name prefix ('' for the whole server) is reused for ttl seconds
+    instead of asking the server again.  In between, Gerrit events and
+    the changes made by this tool keep it current.
+
+    Branches may be known completely (from ls-user-refs or because the
+    project was just created), one at a time (from a bulk query for a
+    single branch, a local mirror or ref-updated events) or not at all;
+    has_branch() returns None when it cannot tell.
+    """
+    log = logging.getLogger("manage_projects.ServerInventory")
+
+    def __init__(self, path=None, ttl=0):
+        self.path = path
+        self.ttl = float(ttl)
+        self.descriptions = {}
+        # project name -> {refs/heads/* ref: present (True/False)}
+        self._branches = {}
+        # projects whose _branches entry lists every branch
+        self._complete = set()
+        # name prefix -> time it was last listed from the server
+        self.listings = {}
+        self._lock = threading.RLock()
+        self._dirty = False
+
+    def load(self):
+        if not self.path:
+            return self
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            self.log.debug("No usable inventory in %s, starting fresh" %
+                           self.path)
+            return self
+        with self._lock:
+            self.listings = data.get('listings', {})
+            for name, entry in data.get('projects', {}).items():
+                self.descriptions[name] = entry.get('description')
+                if entry.get('branches') is not None:
+                    self._branches[name] = entry['branches']
+                if entry.get('complete'):
+                    self._complete.add(name)
+        return self
+
+    def save(self):
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            projects = {}
+            for name, description in self.descriptions.items():
+                entry = dict(description=description)
+                if name in self._branches:
+                    entry['branches'] = self._branches[name]
+                if name in self._complete:
+                    entry['complete'] = True
+                projects[name] = entry
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmpname = '%s.tmp' % self.path
+            with open(tmpname, 'w') as fp:
+                json.dump(dict(listings=self.listings, projects=projects),
+                          fp, sort_keys=True)
+            os.rename(tmpname, self.path)
+            self._dirty = False
+
+    def __contains__(self, name):
+        return name in self.descriptions
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def get(self, name, default=None):
+        """The description of name, or default if it is not on the server."""
+        return self.descriptions.get(name, default)
+
+    def is_fresh(self, prefix, now=None):
+        """Whether a listing covering prefix is younger than ttl."""
+        if self.ttl <= 0:
+            return False
+        now = now or time.time()
+        with self._lock:
+            return any(prefix.startswith(listed) and now - when <= self.ttl
+                       for listed, when in self.listings.items())
+
+    def refresh(self, gerrit, prefixes=None):
+        """List whatever part of the server is not freshly known.
+
+        prefixes limits the listing to projects starting with one of them;
+        None means the whole server.  Returns the prefixes listed.
+        """
+        now = time.time()
+        stale = [prefix for prefix in (prefixes or [''])
+                 if not self.is_fresh(prefix, now)]
+        for prefix in stale:
+            projects = parse_project_descriptions(gerrit.listProjects(
+                show_description=True, prefix=prefix or None))
+            self._replace(prefix, projects, now)
+        if not stale:
+            self.log.debug("Using the inventory saved in %s" % self.path)
+        return stale
+
+    def _replace(self, prefix, projects, when):
+        with self._lock:
+            for name in [name for name in self.descriptions
+                         if name.startswith(prefix)]:
+                del self.descriptions[name]
+                # refs may have moved since they were recorded
+                self._branches.pop(name, None)
+                self._complete.discard(name)
+            self.descriptions.update(projects)
+            if not prefix:
+                self.listings = {}
+            self.listings[prefix] = when
+            self._dirty = True
+
+    def add(self, name, description=None):
+        with self._lock:
+            if name not in self.descriptions:
+                self.descriptions[name] = description
+                self._dirty = True
+
+    def remove(self, name):
+        with self._lock:
+            self.descriptions.pop(name, None)
+            self._branches.pop(name, None)
+            self._complete.discard(name)
+            self._dirty = True
+
+    def set_description(self, name, description):
+        with self._lock:
+            self.descriptions[name] = description
+            self._dirty = True
+
+    def has_branch(self, name, ref):
+        """Whether project name has branch ref; None if not known."""
+        with self._lock:
+            if name not in self.descriptions:
+                return False
+            branches = self._branches.get(name, {})
+            if ref in branches:
+                return branches[ref]
+            if name in self._complete:
+                return False
+            return None
+
+    def set_heads(self, name, refs):
+        """Record the complete list of branches of name."""
+        with self._lock:
+            self._branches[name] = dict(
+                (ref, True) for ref in refs if ref.startswith('refs/heads/'))
+            self._complete.add(name)
+            self._dirty = True
+
+    def set_branch(self, name, ref, present):
+        """Record whether name has branch ref."""
+        with self._lock:
+            if self._branches.setdefault(name, {}).get(ref) != present:
+                self._branches[name][ref] = present
+                self._dirty = True
+
+    def forget_heads(self, name):
+        """Mark the branches of name unknown, e.g. after pushing to it."""
+        with self._lock:
+            self._complete.discard(name)
+            if self._branches.pop(name, None) is not None:
+                self._dirty = True
+
+    def handle_event(self, event):
+        etype = event.get('type')
+        if etype == 'project-created':
+            name = event.get('projectName')
+            with self._lock:
+                if name not in self.descriptions:
+                    self.add(name)
+                    self.set_heads(name, [])
+        elif etype == 'project-deleted':
+            self.remove(event.get('projectName'))
+        elif etype == 'ref-updated':
+            update = event.get('refUpdate', {})
+            name = update.get('project')
+            ref = update.get('refName', '')
+            if not name:
+                return
+            self.add(name)
+            if ref.startswith('refs/heads/'):
+                self.set_branch(name, ref,
+                                update.get('newRev', ZERO_REV) != ZERO_REV)
@@ -0,0 +1,271 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Run instrumentation: phase spans, command counters and latencies.
+
+Everything is recorded into a process wide Metrics instance (REGISTRY).
+Spans time a phase of work, optionally for a project; commands are SSH
+commands and REST requests sent to Gerrit and subprocesses started by
+run_command, whose CPU time is recorded as well.  The result can be
+streamed as a JSON-lines trace and dumped in the Prometheus textfile
+collector format.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+PHASE = 'phase'
+SSH = 'ssh'
+HTTP = 'http'
+EXEC = 'exec'
+CPU = 'cpu'
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, 300.0)
+
+PREFIX = 'gerrit_projects'
+HISTOGRAMS = {
+    PHASE: ('%s_phase_duration_seconds' % PREFIX, 'phase',
+            'Time spent in each phase of processing a project.'),
+    SSH: ('%s_ssh_command_duration_seconds' % PREFIX, 'command',
+          'Latency of SSH commands sent to Gerrit.'),
+    HTTP: ('%s_http_request_duration_seconds' % PREFIX, 'request',
+           'Latency of REST requests sent to Gerrit.'),
+    EXEC: ('%s_subprocess_duration_seconds' % PREFIX, 'command',
+           'Latency of subprocesses started by run_command.'),
+    CPU: ('%s_subprocess_cpu_seconds' % PREFIX, 'command',
+          'CPU time of subprocesses started by run_command.'),
+}
+FAILURES = ('%s_failures_total' % PREFIX,
+            'Phases and commands that raised or exited non-zero.')
+PROJECTS = ('%s_projects_total' % PREFIX,
+            'Projects processed, by outcome.')
+
+
+def command_name(argv):
+    """Short, low cardinality label for a command line.
+
+    'git --git-dir=x fetch origin' becomes 'git fetch', 'gerrit
+    create-project --name x' becomes 'gerrit create-project' and anything
+    else is reduced to the basename of its program.
+    """
+    words = []
+    args = iter(argv)
+    for arg in args:
+        if words and arg in ('-C', '-c'):
+            next(args, None)
+            continue
+        if words and arg.startswith('-'):
+            continue
+        words.append(arg if words else os.path.basename(arg))
+        if len(words) == 2 or words[0] not in ('git', 'gerrit'):
+            break
+    return ' '.join(words)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Timer(object):
+    """Handed out by Metrics.timer(); set status (and cpu) before it ends."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.status = None
+        self.cpu = None
+
+
+class Metrics(object):
+    """Thread safe store of spans, counters and latency histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._trace = None
+        self.started = time.time()
+        self.histograms = {}
+        self.failures = {}
+        self.projects = {}
+
+    def open_trace(self, path):
+        """Append a JSON line per span and per command to path."""
+        self.close_trace()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._trace = open(path, 'a')
+
+    def close_trace(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+    @property
+    def project(self):
+        """The project whose span is open in the calling thread."""
+        return getattr(self._local, 'project', None)
+
+    def _observe(self, kind, name, value):
+        key = (kind, name)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def _record(self, kind, name, start, duration, status, cpu=None):
+        failed = status not in (None, 0)
+        with self._lock:
+            key = (kind, name)
+            self._observe(kind, name, duration)
+            if cpu is not None:
+                self._observe(CPU, name, cpu)
+            if failed:
+                self.failures[key] = self.failures.get(key, 0) + 1
+            if self._trace is not None:
+                entry = dict(ts=round(start, 6), type=kind, name=name,
+                             duration=round(duration, 6),
+                             thread=threading.current_thread().name)
+                if self.project:
+                    entry['project'] = self.project
+                if status is not None:
+                    entry['status'] = status
+                if cpu is not None:
+                    entry['cpu'] = round(cpu, 6)
+                self._trace.write(json.dumps(entry, sort_keys=True) + '\n')
+                self._trace.flush()
+
+    def record(self, kind, name, start, status=None, cpu=None):
+        """Record a command called name that ran from start until now."""
+        self._record(kind, name, start, time.time() - start, status, cpu)
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        """Time the body as a command (SSH, HTTP or EXEC) called name.
+
+        A body that raises is recorded with status 'error'.
+        """
+        timer = Timer()
+        try:
+            yield timer
+        except Exception:
+            timer.status = 'error'
+            raise
+        finally:
+            self._record(kind, name, timer.start,
+                         time.time() - timer.start, timer.status, timer.cpu)
+
+    @contextlib.contextmanager
+    def span(self, phase, project=None):
+        """Time the body as phase, attributing nested work to project."""
+        previous = self.project
+        if project is not None:
+            self._local.project = project
+        try:
+            with self.timer(PHASE, phase):
+                yield
+        finally:
+            self._local.project = previous
+
+    def timed(self, phase=None):
+        """Decorator running the function inside a span."""
+        def decorator(func):
+            name = phase or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count_project(self, outcome):
+        with self._lock:
+            self.projects[outcome] = self.projects.get(outcome, 0) + 1
+
+    def summary(self):
+        """Return (kind, name, count, total seconds) tuples, slowest first."""
+        with self._lock:
+            items = [(kind, name, h.count, h.sum)
+                     for (kind, name), h in self.histograms.items()]
+        return sorted(items, key=lambda item: item[3], reverse=True)
+
+    def format_prometheus(self):
+        lines = []
+        with self._lock:
+            for kind in (PHASE, SSH, HTTP, EXEC, CPU):
+                hist_name, label, help_text = HISTOGRAMS[kind]
+                lines.append('# HELP %s %s' % (hist_name, help_text))
+                lines.append('# TYPE %s histogram' % hist_name)
+                for (k, name), h in sorted(self.histograms.items()):
+                    if k != kind:
+                        continue
+                    labels = '%s="%s"' % (label, _escape(name))
+                    cumulative = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (
+                            hist_name, labels, repr(bound), cumulative))
+                    lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                        hist_name, labels, h.count))
+                    lines.append('%s_sum{%s} %f' % (hist_name, labels, h.sum))
+                    lines.append('%s_count{%s} %d' % (hist_name, labels,
+                                                      h.count))
+            lines.append('# HELP %s %s' % FAILURES)
+            lines.append('# TYPE %s counter' % FAILURES[0])
+            for (kind, name), count in sorted(self.failures.items()):
+                lines.append('%s{kind="%s",name="%s"} %d' % (
+                    FAILURES[0], kind, _escape(name), count))
+            lines.append('# HELP %s %s' % PROJECTS)
+            lines.append('# TYPE %s counter' % PROJECTS[0])
+            for outcome, count in sorted(self.projects.items()):
+                lines.append('%s{outcome="%s"} %d' % (PROJECTS[0], outcome,
+                                                      count))
+        now = time.time()
+        lines.append('# TYPE %s_run_duration_seconds gauge' % PREFIX)
+        lines.append('%s_run_duration_seconds %f' % (PREFIX,
+                                                     now - self.started))
+        lines.append('# TYPE %s_last_run_timestamp_seconds gauge' % PREFIX)
+        lines.append('%s_last_run_timestamp_seconds %d' % (PREFIX, now))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Atomically write the textfile collector file at path."""
+        tmpname = '%s.tmp' % path
+        with open(tmpname, 'w') as fp:
+            fp.write(self.format_prometheus())
+        os.rename(tmpname, path)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+REGISTRY = Metrics()
@@ -28,6 +28,25 @@
 # gerrit-user=gerrit2
 # gerrit-system-user=gerrit2
 # gerrit-system-group=gerrit2
+# gerrit-ssh-connections=1
+# gerrit-max-in-flight=8
+# gerrit-max-sessions=8
+# gerrit-reserved-sessions=2
+# gerrit-backend=ssh
+# gerrit-url=https://review.openstack.org
+# gerrit-http-user=gerrit2
+# gerrit-http-password=secret
+# gerrit-http-connections=4
+# group-cache-ttl=0
+# inventory-ttl=0
+# stream-events=false
+# event-queue-size=10000
+# event-queue-overflow=drop-oldest
+# share-mirror-objects=true
+# metrics-file=/var/lib/node_exporter/textfile/gerrit_projects.prom
+# trace-file=/var/log/gerrit-projects/trace.jsonl
+# run-timeout=3600
+# command-timeout=1800
 #
 # manage_projects.py reads a project listing file called projects.yaml
 # It should look like:
@@ -41,48 +60,167 @@
 #   acl-config: project.config
 #   acl-parameters:
 #     project: OTHER_PROJECT_NAME
+#
+# More projects can be listed in *.yaml files in a projects.d directory
+# next to projects.yaml, each holding a list like the one above.
 
 import argparse
+import bisect
 import ConfigParser
+import errno
+import fnmatch
+import glob
+import hashlib
 import yaml
 import logging
 import os
 import sys
 import re
 import shlex
+import shutil
 import subprocess
 import tempfile
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import gerrit_projects.concurrency as concurrency
+import gerrit_projects.executor as executor
 import gerrit_projects.gerritlib as gerritlib
+import gerrit_projects.inventory as inventory
+import gerrit_projects.metrics as metrics
+import gerrit_projects.retry as retry
+import gerrit_projects.state as state
+
+from gerrit_projects.inventory import parse_project_descriptions
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+
+# libyaml's loader is many times faster than the pure Python one
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SNAPSHOT_VERSION = 1
+
+
+def load_yaml_file(path, snapshot_dir=None):
+    """Return the list of YAML documents in path.
+
+    With snapshot_dir the parsed documents are pickled there and reused
+    for as long as the file keeps its mtime and size or, failing that,
+    its sha1.
+    """
+    if not snapshot_dir:
+        with open(path, 'rb') as fp:
+            return list(yaml.load_all(fp, Loader=YAML_LOADER))
+
+    st = os.stat(path)
+    snapshot_path = os.path.join(snapshot_dir, '%s-py%d.pickle' % (
+        hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest(),
+        sys.version_info[0]))
+    snapshot = _read_snapshot(snapshot_path)
+    if snapshot and (snapshot['mtime'], snapshot['size']) == (
+            st.st_mtime, st.st_size):
+        return snapshot['docs']
+
+    with open(path, 'rb') as fp:
+        content = fp.read()
+    digest = hashlib.sha1(content).hexdigest()
+    if snapshot and snapshot['sha1'] == digest:
+        docs = snapshot['docs']
+    else:
+        docs = list(yaml.load_all(content, Loader=YAML_LOADER))
+    _write_snapshot(snapshot_path, dict(version=SNAPSHOT_VERSION,
+                                        mtime=st.st_mtime, size=st.st_size,
+                                        sha1=digest, docs=docs))
+    return docs
+
+
+def _read_snapshot(path):
+    try:
+        with open(path, 'rb') as fp:
+            snapshot = pickle.load(fp)
+    except (IOError, OSError):
+        return None
+    except Exception:
+        log.debug("Ignoring unreadable registry snapshot %s" % path)
+        return None
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def _write_snapshot(path, snapshot):
+    dirname = os.path.dirname(path)
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(snapshot, fp, 2)
+        os.rename(tmpname, path)
+    except (IOError, OSError) as e:
+        log.debug("Could not write registry snapshot %s: %s" % (path, e))
 
 
 class ProjectsRegistry(object):
     """read config from ini or yaml file.
 
     It could be used as dict 'project name' -> 'project properties'.
+    Projects from *.yaml fragments in fragments_dir (projects.d next to
+    yaml_file by default) are added after those of yaml_file.  Parsed
+    files are snapshotted in cache-dir/registry when an ini file exists.
     """
-    def __init__(self, ini_file, yaml_file, single_doc=True):
-        self.yaml_doc = [c for c in yaml.safe_load_all(open(yaml_file))]
+    def __init__(self, ini_file, yaml_file, single_doc=True,
+                 fragments_dir=None):
         self.ini_file = ini_file
+        self.yaml_file = yaml_file
         self.single_doc = single_doc
+        if fragments_dir is None:
+            fragments_dir = os.path.join(os.path.dirname(yaml_file),
+                                         'projects.d')
+        self.fragments_dir = fragments_dir
 
-        self.configs_list = []
         self.defaults = {}
+        snapshot_dir = None
+        if os.path.exists(self.ini_file):
+            self.defaults = ConfigParser.ConfigParser()
+            self.defaults.read(self.ini_file)
+            snapshot_dir = os.path.join(
+                self.get_defaults('cache-dir', '/var/tmp/cache'), 'registry')
+        self.yaml_doc = load_yaml_file(yaml_file, snapshot_dir)
+        self.fragments = dict(
+            (path, load_yaml_file(path, snapshot_dir))
+            for path in self.fragment_files())
+
+        self.configs_list = []
         self._parse_file()
 
+    def fragment_files(self):
+        return sorted(glob.glob(os.path.join(self.fragments_dir, '*.yaml')))
+
+    def source_paths(self):
+        """Files and directories whose changes call for a reload."""
+        return [self.yaml_file, self.fragments_dir] + self.fragment_files()
+
     def _parse_file(self):
         if self.single_doc:
-            self.configs_list = self.yaml_doc[0]
+            self.configs_list = list(self.yaml_doc[0] or [])
         else:
-            self.configs_list = self.yaml_doc[1]
+            self.configs_list = list(self.yaml_doc[1] or [])
 
-        if os.path.exists(self.ini_file):
-            self.defaults = ConfigParser.ConfigParser()
-            self.defaults.read(self.ini_file)
-        else:
+        for path in sorted(self.fragments):
+            docs = self.fragments[path]
+            if docs and docs[0]:
+                self.configs_list.extend(docs[0])
+
+        if not os.path.exists(self.ini_file):
             try:
                 self.defaults = self.yaml_doc[0][0]
             except IndexError:
@@ -93,6 +231,29 @@ class ProjectsRegistry(object):
             configs[section['project']] = section
 
         self.configs = configs
+        self._build_index()
+
+    def _build_index(self):
+        # Sorted names let a glob only look at names sharing its literal
+        # prefix; the other indexes map a value to project names.
+        self.sorted_names = sorted(self.configs)
+        self.positions = {}
+        self.by_acl_config = {}
+        self.by_option = {}
+        for position, section in enumerate(self.configs_list):
+            name = section['project']
+            self.positions[name] = position
+            acl_config = section.get('acl-config', '%s.config' % name)
+            self.by_acl_config.setdefault(acl_config, set()).add(name)
+            for option in section.get('options') or []:
+                self.by_option.setdefault(option, set()).add(name)
+
+    def names_with_prefix(self, prefix):
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        for name in self.sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            yield name
 
     def __getitem__(self, item):
         return self.configs[item]
@@ -122,11 +283,116 @@ class ProjectsRegistry(object):
 log = logging.getLogger("manage_projects")
 
 
-class FetchConfigException(Exception):
-    pass
+SELECT_REGEX = 're:'
+SELECT_ACL_CONFIG = 'acl:'
+SELECT_OPTION = 'option:'
+GLOB_CHARS = '*?['
+# Above this many 'ls-projects --prefix' calls list the whole server instead
+MAX_PREFIX_LISTINGS = 20
+
+
+def glob_prefix(pattern):
+    """The literal part of a glob before its first wildcard."""
+    for i, c in enumerate(pattern):
+        if c in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
+
+
+class ProjectSelector(object):
+    """Pick projects out of a ProjectsRegistry through its indexes.
+
+    Each pattern is one of:
+      NAME           an exact project name
+      GLOB           a shell style pattern, e.g. 'infra/*'
+      re:REGEX       a regular expression matching the whole name
+      acl:FILE       projects using FILE as their acl-config
+      option:OPTION  projects with OPTION in their options
+    A project is selected if it matches any of the patterns.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.names = set()
+        self.globs = []
+        self.regexes = []
+        self.acl_configs = set()
+        self.options = set()
+        for pattern in self.patterns:
+            if pattern.startswith(SELECT_REGEX):
+                self.regexes.append(
+                    re.compile(r'(?:%s)\Z' % pattern[len(SELECT_REGEX):]))
+            elif pattern.startswith(SELECT_ACL_CONFIG):
+                self.acl_configs.add(pattern[len(SELECT_ACL_CONFIG):])
+            elif pattern.startswith(SELECT_OPTION):
+                self.options.add(pattern[len(SELECT_OPTION):])
+            elif any(c in pattern for c in GLOB_CHARS):
+                self.globs.append(pattern)
+            else:
+                self.names.add(pattern)
 
+    def __nonzero__(self):
+        return bool(self.patterns)
+    __bool__ = __nonzero__
 
-class CopyACLException(Exception):
+    def matches(self, section):
+        name = section['project']
+        if name in self.names:
+            return True
+        if any(fnmatch.fnmatchcase(name, g) for g in self.globs):
+            return True
+        if any(r.match(name) for r in self.regexes):
+            return True
+        if section.get('acl-config', '%s.config' % name) in self.acl_configs:
+            return True
+        options = section.get('options') or []
+        return any(option in self.options for option in options)
+
+    def select(self, registry):
+        """Return the matching sections, in registry order."""
+        if not self.patterns:
+            return list(registry.configs_list)
+        selected = set(name for name in self.names
+                       if name in registry.configs)
+        for pattern in self.globs:
+            selected.update(
+                name for name in registry.names_with_prefix(
+                    glob_prefix(pattern))
+                if fnmatch.fnmatchcase(name, pattern))
+        for regex in self.regexes:
+            selected.update(name for name in registry.sorted_names
+                            if regex.match(name))
+        for acl_config in self.acl_configs:
+            selected.update(registry.by_acl_config.get(acl_config, ()))
+        for option in self.options:
+            selected.update(registry.by_option.get(option, ()))
+        for name in self.names - selected:
+            log.warning("Project %s is not in the registry" % name)
+        return [registry.configs[name] for name in
+                sorted(selected, key=registry.positions.get)]
+
+    def prefixes(self, sections, limit=MAX_PREFIX_LISTINGS):
+        """Name prefixes whose server listing covers sections.
+
+        Returns None when listing the whole server is the better deal.
+        """
+        if not self.patterns:
+            return None
+        prefixes = set(glob_prefix(pattern) for pattern in self.globs)
+        # A glob starting with a wildcard says nothing about the names
+        prefixes.discard('')
+        for section in sections:
+            name = section['project']
+            if not any(name.startswith(prefix) for prefix in prefixes):
+                prefixes.add(name)
+                if len(prefixes) > limit:
+                    return None
+        return sorted(prefix for prefix in prefixes
+                      if not any(prefix != other and prefix.startswith(other)
+                                 for other in prefixes))
+
+
+class FetchConfigException(Exception):
     pass
 
 
@@ -134,19 +400,87 @@ class CreateGroupException(Exception):
     pass
 
 
-def run_command(cmd, status=False, env=None):
+# git commands that talk to a remote
+GIT_TRANSPORT_COMMANDS = set(['git clone', 'git fetch', 'git ls-remote',
+                              'git push', 'git remote'])
+# Shared with the Gerrit object by main(); git processes reaching Gerrit
+# wait for one of its slots.
+_transport_limiter = None
+# Start of the URLs of repositories on Gerrit, set by main()
+_gerrit_url = None
+# Remotes of the local copies in cache-dir that point at Gerrit
+GERRIT_REMOTES = set(['origin'])
+# Seconds any command may run, set by main() from command-timeout
+_command_timeout = None
+# Network hiccups of git talking to a remote are retried
+GIT_TRANSPORT_RETRY = retry.RetryPolicy(initial=0.1, maximum=5.0, attempts=4,
+                                        timeout=60)
+
+
+def is_gerrit_transport(name, cmd_list):
+    """Whether a git command talks to Gerrit, rather than e.g. upstream."""
+    if name not in GIT_TRANSPORT_COMMANDS:
+        return False
+    for arg in cmd_list[2:]:
+        if arg in GERRIT_REMOTES or (_gerrit_url and
+                                     arg.startswith(_gerrit_url)):
+            return True
+    return False
+
+
+def transport_slot(name, cmd_list):
+    if (_transport_limiter is None or
+            not is_gerrit_transport(name, cmd_list)):
+        return concurrency.unlimited(name)
+    # How long git takes depends on how much it transfers, so only its
+    # errors and timeouts tell about congestion.
+    return _transport_limiter.slot(name, timed=False)
+
+
+def run_command(cmd, status=False, env=None, data=None, timeout=None):
+    """Run cmd with env added to the environment and return its output.
+
+    With status, (return code, output) is returned instead.  Safe to call
+    from several threads; see executor.run for the limits on output and
+    time.
+    """
     env = env or {}
     cmd_list = shlex.split(str(cmd))
-    newenv = os.environ
+    newenv = dict(os.environ)
     newenv.update(env)
+    timeout = timeout or _command_timeout
     log.debug("Executing command: %s" % " ".join(cmd_list))
-    p = subprocess.Popen(cmd_list, stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT, env=newenv)
-    (out, nothing) = p.communicate()
-    log.info("Return code: %s" % p.returncode)
-    log.info("Command said: %s" % out.strip())
+    name = metrics.command_name(cmd_list)
+    if name in GIT_TRANSPORT_COMMANDS:
+        attempts = GIT_TRANSPORT_RETRY.tries()
+    else:
+        attempts = [1]
+    for attempt in attempts:
+        with transport_slot(name, cmd_list) as slot:
+            with metrics.REGISTRY.timer(metrics.EXEC, name) as timer:
+                result = executor.run(cmd_list, newenv, data, timeout)
+                timer.status = result.returncode
+                timer.cpu = result.cpu
+            out = result.output
+            if result.timed_out:
+                slot.overloaded = True
+            elif result.returncode:
+                slot.check(out)
+        if result.timed_out:
+            log.error("Killed %s after %ss" % (" ".join(cmd_list), timeout))
+            break
+        if result.returncode == 0 or not retry.transient(out):
+            break
+        log.debug("Attempt %d of %s failed: %s" % (attempt, name,
+                                                   out.strip()))
+    if result.truncated:
+        log.warning("Kept only the first %d bytes of output of %s" %
+                    (len(out), name))
+    log.debug("Return code %s after %.3fs, %.3fs CPU" % (
+        result.returncode, result.wall, result.cpu))
+    log.debug("Command said: %s" % out.strip())
     if status:
-        return (p.returncode, out.strip())
+        return (result.returncode, out.strip())
     return out.strip()
 
 
@@ -155,146 +489,426 @@ def run_command_status(cmd, env=None):
     return run_command(cmd, True, env)
 
 
+# The copies of projects in cache-dir are bare repositories: ACL commits
+# are built from objects (see commit_files) and nothing is checked out.
 def git_command(repo_dir, sub_cmd, env=None):
     env = env or {}
-    git_dir = os.path.join(repo_dir, '.git')
-    cmd = "git --git-dir=%s --work-tree=%s %s" % (git_dir, repo_dir, sub_cmd)
+    cmd = "git --git-dir=%s %s" % (repo_dir, sub_cmd)
     status, _ = run_command(cmd, True, env)
     return status
 
 
-def git_command_output(repo_dir, sub_cmd, env=None):
+def git_command_output(repo_dir, sub_cmd, env=None, data=None):
     env = env or {}
-    git_dir = os.path.join(repo_dir, '.git')
-    cmd = "git --git-dir=%s --work-tree=%s %s" % (git_dir, repo_dir, sub_cmd)
-    status, out = run_command(cmd, True, env)
+    cmd = "git --git-dir=%s %s" % (repo_dir, sub_cmd)
+    status, out = run_command(cmd, True, env, data)
     return (status, out)
 
 
-def fetch_config(project, remote_url, repo_path, env=None):
+def read_local_ref(repo_path, ref):
+    """Return the sha ref points at, or None, reading files instead of git."""
+    try:
+        with open(os.path.join(repo_path, ref)) as fp:
+            return fp.read().strip() or None
+    except IOError:
+        pass
+    try:
+        with open(os.path.join(repo_path, 'packed-refs')) as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except IOError:
+        pass
+    return None
+
+
+def local_ref_exists(repo_path, ref):
+    """Check for a ref by reading the repository, without running git."""
+    return read_local_ref(repo_path, ref) is not None
+
+
+def discard_work_tree_copy(repo_path):
+    """Remove a copy left in cache-dir by versions using a work tree.
+
+    It gets replaced by a bare clone; only the clone is downloaded again.
+    """
+    if os.path.isdir(os.path.join(repo_path, '.git')):
+        log.info("Replacing %s with a bare repository" % repo_path)
+        shutil.rmtree(repo_path)
+
+
+_committer_ident = []
+
+
+def committer_ident(author):
+    """The committer git would use, as 'Name <email>'; author if unset."""
+    if not _committer_ident:
+        status, out = run_command("git var GIT_COMMITTER_IDENT", True)
+        # Drop the timestamp, commits made later get their own
+        ident = out.rsplit(' ', 2)[0] if status == 0 else None
+        _committer_ident.append(ident)
+    return _committer_ident[0] or author
+
+
+def commit_files(repo_path, ref, files, message, author, parent=None):
+    """Commit files (path -> text) on top of parent's tree as ref.
+
+    The blobs, tree and commit are written straight into the object
+    database by one git fast-import; entries of parent's tree that are
+    not in files are kept.  Returns True on success.
+    """
+    now = int(time.time())
+    stream = [b'commit %s\n' % ref.encode('utf-8')]
+    for role, ident in (('author', author),
+                        ('committer', committer_ident(author))):
+        stream.append(('%s %s %d +0000\n' % (role, ident, now)).encode(
+            'utf-8'))
+    message = message.encode('utf-8')
+    stream.append(b'data %d\n%s\n' % (len(message), message))
+    if parent:
+        stream.append(b'from %s^0\n' % parent.encode('utf-8'))
+    for path, text in sorted(files.items()):
+        data = text.encode('utf-8')
+        stream.append(b'M 100644 inline %s\ndata %d\n%s\n' % (
+            path.encode('utf-8'), len(data), data))
+    stream.append(b'done\n')
+    status, out = git_command_output(
+        repo_path, "fast-import --quiet --force --done --date-format=raw",
+        data=b''.join(stream))
+    if status != 0:
+        log.error("Failed to commit to %s in %s: %s" % (ref, repo_path, out))
+        return False
+    return True
+
+
+class MetaConfigWaiter(object):
+    """Wake up fetch_config as soon as Gerrit reports refs/meta/config.
+
+    Consumes the Gerrit event stream on a background thread and remembers
+    which projects had refs/meta/config written (or were created) so that
+    waiters do not have to sleep a fixed interval between polls.  A
+    project is only remembered for keep seconds, so that a long running
+    --watch does not collect every project ever updated.
+    """
+    log = logging.getLogger("manage_projects.MetaConfigWaiter")
+    keep = 60
+
+    def __init__(self, gerrit):
+        self.gerrit = gerrit
+        # project -> when its event was seen
+        self._seen = {}
+        self._swept = time.time()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, handlers=()):
+        """Consume events from the (already watching) gerrit instance.
+
+        Each event is also passed to every callable in handlers.
+        """
+        self._thread = threading.Thread(target=self._run, args=(handlers,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self, handlers):
+        while True:
+            for event in self.gerrit.getEvents(100):
+                for handler in [self.handle_event] + list(handlers):
+                    try:
+                        handler(event)
+                    except Exception:
+                        self.log.exception("Exception handling Gerrit event")
+
+    def handle_event(self, event):
+        etype = event.get('type')
+        if etype == 'ref-updated':
+            update = event.get('refUpdate', {})
+            if update.get('refName') != 'refs/meta/config':
+                return
+            name = update.get('project')
+        elif etype == 'project-created':
+            name = event.get('projectName')
+        else:
+            return
+        if name:
+            now = time.time()
+            with self._cond:
+                if now - self._swept > self.keep:
+                    self._seen = dict(
+                        (project, seen) for project, seen
+                        in self._seen.items() if now - seen <= self.keep)
+                    self._swept = now
+                self._seen[name] = now
+                self._cond.notify_all()
+
+    def wait(self, project, timeout):
+        """Wait up to timeout seconds for an event about project.
+
+        Returns True if one arrived (possibly before the call).
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while project not in self._seen:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            del self._seen[project]
+            return True
+
+
+# Gerrit writes refs/meta/config of a new project shortly after creating
+# it; poll quickly at first.
+META_CONFIG_RETRY = retry.RetryPolicy(initial=0.05, maximum=2.0, timeout=20)
+
+
+def wait_for_meta_config(project, waiter, timeout=2):
+    if waiter:
+        waiter.wait(project['name'], timeout)
+    else:
+        time.sleep(timeout)
+
+
+@metrics.REGISTRY.timed()
+def fetch_config(project, remote_url, repo_path, env=None, waiter=None):
+    """Fetch refs/meta/config into repo_path.
+
+    Returns its (project.config, groups); groups may be None.
+    """
     env = env or {}
-    # Poll for refs/meta/config as gerrit may not have written it out for
-    # us yet.
-    for x in range(10):
-        status = git_command(repo_path, "fetch %s +refs/meta/config:"
-                             "refs/remotes/gerrit-meta/config" %
-                             remote_url, env)
+
+    def wait(delay):
+        wait_for_meta_config(project, waiter, delay)
+
+    # Poll for refs/meta/config and its project.config as gerrit may not
+    # have written them out for us yet.  With a waiter we retry as soon as
+    # gerrit says it has.
+    current = groups = None
+    for attempt in META_CONFIG_RETRY.tries(wait):
+        status, output = git_command_output(
+            repo_path, "fetch %s +refs/meta/config:"
+            "refs/remotes/gerrit-meta/config" % remote_url, env)
         if status == 0:
+            current, groups = read_meta_config(
+                repo_path, 'refs/remotes/gerrit-meta/config')
+            if current is not None:
+                break
+            log.debug("Failed to find project.config for project: %s" %
+                      project['name'])
+        elif retry.permanent(output):
             break
         else:
             log.debug("Failed to fetch refs/meta/config for project: %s" %
                       project['name'])
-            time.sleep(2)
     if status != 0:
         log.error("Failed to fetch refs/meta/config for project: %s" % project['name'])
         raise FetchConfigException()
-
-    # Poll for project.config as gerrit may not have committed an empty
-    # one yet.
-    output = ""
-    for x in range(10):
-        status = git_command(repo_path, "remote update --prune", env)
-        if status != 0:
-            log.error("Failed to update remote: %s" % remote_url)
-            time.sleep(2)
-            continue
-        else:
-            status, output = git_command_output(
-                repo_path, "ls-files --with-tree=remotes/gerrit-meta/config "
-                "project.config", env)
-        if output.strip() != "project.config" or status != 0:
-            log.debug("Failed to find project.config for project: %s" %
-                      project['name'])
-            time.sleep(2)
-        else:
-            break
-    if output.strip() != "project.config" or status != 0:
+    if current is None:
         log.error("Failed to find project.config for project: %s" % project['name'])
         raise FetchConfigException()
+    return (current, groups)
 
-    # Because the following fails if executed more than once you should only
-    # run fetch_config once in each repo.
-    status = git_command(repo_path, "checkout -b config "
-                         "remotes/gerrit-meta/config")
-    if status != 0:
-        log.error("Failed to checkout config for project: %s" % project['name'])
-        raise FetchConfigException()
 
+_acl_environments = {}
+_acl_environments_lock = threading.Lock()
 
-def copy_acl_config(project, repo_path, ACL_DIR):
 
-    if not os.path.exists(os.path.join(ACL_DIR, project['acl_config'])):
-        raise CopyACLException()
+def acl_environment(ACL_DIR, bytecode_dir=None):
+    """Return the process-wide Jinja2 environment for ACL_DIR.
 
-    env = Environment(loader=FileSystemLoader(ACL_DIR))
-    template = env.get_template(project['acl_config'])
-    (fd, tmpname) = tempfile.mkstemp(text=True)
-    template.stream(project=project).dump(tmpname)
-    os.close(fd)
+    Templates are compiled once and kept in the environment's cache; with
+    bytecode_dir the compiled code is also reused across runs.
+    """
+    with _acl_environments_lock:
+        env = _acl_environments.get(ACL_DIR)
+        if env is None:
+            bytecode_cache = None
+            if bytecode_dir:
+                if not os.path.isdir(bytecode_dir):
+                    os.makedirs(bytecode_dir)
+                bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+            env = Environment(loader=FileSystemLoader(ACL_DIR),
+                              bytecode_cache=bytecode_cache)
+            _acl_environments[ACL_DIR] = env
+        return env
+
+
+def render_acl_config(project, ACL_DIR):
+    template = acl_environment(ACL_DIR).get_template(project['acl_config'])
+    return template.render(project=project)
+
+
+class GitCatFile(object):
+    """Read objects from a repository through one git cat-file --batch."""
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._devnull = open(os.devnull, 'w')
+        self._start = time.time()
+        self.proc = subprocess.Popen(
+            ['git', '--git-dir=%s' % git_dir, 'cat-file', '--batch'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=self._devnull, close_fds=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, spec):
+        """Return the contents of spec (e.g. 'ref:path'), or None."""
+        try:
+            self.proc.stdin.write(('%s\n' % spec).encode('utf-8'))
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            return None
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            # '<spec> missing', or git gave up on the repository
+            return None
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)
+        return data.decode('utf-8')
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.proc.wait()
+        self._devnull.close()
+        metrics.REGISTRY.record(metrics.EXEC, 'git cat-file', self._start,
+                                self.proc.returncode)
 
-    acl_dest = os.path.join(repo_path, "project.config")
-    status, _ = run_command("cp %s %s" %
-                            (tmpname, acl_dest), status=True)
-    os.unlink(tmpname)
 
-    if status != 0:
-        raise CopyACLException()
+def read_meta_config(git_dir, ref='refs/meta/config'):
+    """Return (project.config, groups) from ref of a bare repository.
+
+    Either value is None if the repository does not have it.
+    """
+    if not os.path.isdir(git_dir):
+        return (None, None)
+    with GitCatFile(git_dir) as cat_file:
+        return (cat_file.read('%s:project.config' % ref),
+                cat_file.read('%s:groups' % ref))
+
+
+@metrics.REGISTRY.timed()
+def collect_branch_heads(ctx, sections, prefixes=None, branch='master'):
+    """Learn which selected projects have branch, in bulk.
+
+    Only projects without a local copy in cache-dir are looked at, as
+    make_local_copy is the one asking.  Local mirrors are replicas of the
+    server, so a mirror holding the branch settles it without any network
+    traffic.  A mirror without it may just not be replicated yet, so the
+    projects left are settled by one listBranchHeads call per prefix.
+    """
+    ref = 'refs/heads/%s' % branch
+    unknown = set(section['project'] for section in sections
+                  if ctx.inventory.has_branch(section['project'],
+                                              ref) is None and
+                  not os.path.exists(os.path.join(ctx.cache_dir,
+                                                  section['project'])))
+    for name in list(unknown):
+        if local_ref_exists(os.path.join(ctx.local_git_dir,
+                                         '%s.git' % name), ref):
+            ctx.inventory.set_branch(name, ref, True)
+            unknown.discard(name)
+    if len(unknown) < 2:
+        # a single ls-user-refs is cheaper than a bulk listing
+        return
+    log.debug("Asking Gerrit which of %d projects have %s" %
+              (len(unknown), ref))
+    heads = {}
+    for prefix in prefixes or [None]:
+        heads.update(ctx.gerrit.listBranchHeads(branch, prefix))
+    for name in unknown:
+        ctx.inventory.set_branch(name, ref, name in heads)
 
-    status = git_command(repo_path, "diff --quiet")
-    return status != 0
 
+def acl_is_current(acl, current, groups):
+    """Whether a meta/config with current and groups needs no push of acl.
 
-def push_acl_config(project, remote_url, repo_path, gitid, env=None):
+    project.config has to match exactly and groups has to list every
+    group acl refers to.
+    """
+    if current is None or current != acl:
+        return False
+    known = set(line.split('\t', 1)[-1].strip()
+                for line in (groups or '').splitlines())
+    for line in acl.splitlines():
+        r = re.match(r'^.*\sgroup\s+(.*)$', line)
+        if r and r.group(1) not in known:
+            return False
+    return True
+
+
+def mirror_acl_is_current(project, ACL_DIR, mirror_path):
+    """Check the rendered ACL against the local mirror's meta/config."""
+    current, groups = read_meta_config(mirror_path)
+    return acl_is_current(render_acl_config(project, ACL_DIR), current,
+                          groups)
+
+
+@metrics.REGISTRY.timed()
+def push_acl_config(project, remote_url, repo_path, files, gitid, env=None):
+    """Commit files on top of the fetched meta/config and push them."""
     env = env or {}
-    cmd = "commit -a -m'Update project config.' --author='%s'" % gitid
-    status = git_command(repo_path, cmd)
-    if status != 0:
+    if not commit_files(repo_path, 'refs/meta/config', files,
+                        'Update project config.', gitid,
+                        parent='refs/remotes/gerrit-meta/config'):
         log.error("Failed to commit config for project: %s" % project['name'])
         return False
     status, out = git_command_output(repo_path,
-                                     "push %s HEAD:refs/meta/config" %
-                                     remote_url, env)
+                                     "push %s refs/meta/config:"
+                                     "refs/meta/config" % remote_url, env)
     if status != 0:
         log.error("Failed to push config for project: %s" % project['name'])
         return False
     return True
 
 
-def get_group_uuid(gerrit, group):
-    uuid = gerrit.getGroupUUID(group)
-    if uuid:
-        return uuid
-    gerrit.createGroup(group)
-    uuid = gerrit.getGroupUUID(group)
-    if uuid:
-        return uuid
-    return None
+_create_group_lock = threading.Lock()
+# Groups created by this run, so that concurrent jobs create each once
+_created_groups = set()
+
+
+def get_group_uuids(gerrit, groups):
+    """Resolve groups to UUIDs, creating the missing ones, all at once."""
+    uuids = gerrit.getGroupUUIDs(groups)
+    missing = [group for group in groups if not uuids[group]]
+    if not missing:
+        return uuids
+    with _create_group_lock:
+        create = [group for group in missing if group not in _created_groups]
+        if create:
+            for group, error in gerrit.createGroups(create).items():
+                if error is not None:
+                    log.error("Failed to create group %s: %s" %
+                              (group, error))
+                else:
+                    _created_groups.add(group)
+    uuids.update(gerrit.getGroupUUIDs(missing))
+    return uuids
 
 
-def create_groups_file(project, gerrit, repo_path):
-    acl_config = os.path.join(repo_path, "project.config")
-    group_file = os.path.join(repo_path, "groups")
-    uuids = {}
-    for line in open(acl_config, 'r'):
+@metrics.REGISTRY.timed()
+def make_groups_file(gerrit, acl):
+    """Return the groups file for acl, creating missing groups."""
+    groups = []
+    for line in acl.splitlines():
         r = re.match(r'^.*\sgroup\s+(.*)$', line)
-        if r:
-            group = r.group(1)
-            if group in uuids.keys():
-                continue
-            uuid = get_group_uuid(gerrit, group)
-            if uuid:
-                uuids[group] = uuid
-            else:
-                log.error("Unable to get UUID for group %s." % group)
-                raise CreateGroupException()
-    if uuids:
-        with open(group_file, 'w') as fp:
-            for group, uuid in uuids.items():
-                fp.write("%s\t%s\n" % (uuid, group))
-    status = git_command(repo_path, "add groups")
-    if status != 0:
-        log.error("Failed to add groups file for project: %s" % project['name'])
-        raise CreateGroupException()
+        if r and r.group(1) not in groups:
+            groups.append(r.group(1))
+    uuids = get_group_uuids(gerrit, groups)
+    for group in groups:
+        if not uuids[group]:
+            log.error("Unable to get UUID for group %s." % group)
+            raise CreateGroupException()
+    return "".join("%s\t%s\n" % (uuids[group], group) for group in groups)
 
 
 def make_ssh_wrapper(gerrit_user, gerrit_key):
@@ -314,13 +928,31 @@ def find_description_override(repo_path):
     return None
 
 
-def make_local_copy(repo_path, project, project_list,
+def gerrit_has_branch(inventory, gerrit, name, ref):
+    """Whether project name exists on the server with branch ref.
+
+    Normally answered by the inventory (see collect_branch_heads); only
+    projects it knows nothing about cost an ls-user-refs call.
+    """
+    present = inventory.has_branch(name, ref)
+    if present is None:
+        inventory.set_heads(name, gerrit.listProjectRefs(name))
+        present = inventory.has_branch(name, ref)
+    return present
+
+
+@metrics.REGISTRY.timed()
+def make_local_copy(repo_path, project, inventory,
                     git_opts, ssh_env, GERRIT_HOST, GERRIT_PORT,
                     project_git, GERRIT_GITID, gerrit):
 
-    # Ensure that the base location exists
-    if not os.path.exists(os.path.dirname(repo_path)):
+    # Ensure that the base location exists; another job may be creating
+    # it at the same time
+    try:
         os.makedirs(os.path.dirname(repo_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
     # Three choices
     #  - If gerrit has it, get from gerrit
@@ -333,14 +965,25 @@ def make_local_copy(repo_path, project, project_list,
     #                we should consider 'gerrit has it' to be
     #                'gerrit repo has a master branch'
     # ^DONE(kincl)
-    if project['name'] in project_list and 'refs/heads/master' in gerrit.listProjectRefs(project['name']):
-        run_command(
-            "git clone %(remote_url)s %(repo_path)s" % git_opts,
-            env=ssh_env)
+    if gerrit_has_branch(inventory, gerrit, project['name'],
+                         'refs/heads/master'):
+        if git_opts.get('mirror_path'):
+            # Borrow objects already replicated to the local mirror
+            # instead of downloading them all again.
+            run_command(
+                "git clone --bare --single-branch --reference-if-able "
+                "%(mirror_path)s %(remote_url)s %(repo_path)s" % git_opts,
+                env=ssh_env)
+        else:
+            run_command(
+                "git clone --bare --single-branch %(remote_url)s "
+                "%(repo_path)s" % git_opts,
+                env=ssh_env)
         if project['upstream']:
             git_command(
                 repo_path,
-                "remote add -f upstream %(upstream)s" % git_opts)
+                "remote add -f upstream %(upstream)s" % git_opts,
+                env=ssh_env)
         return None
 
     # Gerrit doesn't have it, but it has an upstream configured
@@ -350,44 +993,39 @@ def make_local_copy(repo_path, project, project_list,
     # purposes, so rename origin to upstream and add a new
     # origin remote that points at gerrit
     elif project['upstream']:
-        run_command(
-            "git clone %(upstream)s %(repo_path)s" % git_opts,
-            env=ssh_env)
+        run_command("git init --bare %s" % repo_path)
         git_command(
             repo_path,
-            "fetch origin +refs/heads/*:refs/copy/heads/*",
+            "remote add -f upstream %(upstream)s" % git_opts,
             env=ssh_env)
-        git_command(repo_path, "remote rename origin upstream")
         git_command(
             repo_path,
             "remote add origin %(remote_url)s" % git_opts)
-        return "push %s +refs/copy/heads/*:refs/heads/*"
+        return "push %s +refs/remotes/upstream/*:refs/heads/*"
 
     # Neither gerrit has it, nor does it have an upstream,
     # just create a whole new one
     else:
-        run_command("git init %s" % repo_path)
+        run_command("git init --bare %s" % repo_path)
         git_command(
             repo_path,
             "remote add origin %(remote_url)s" % git_opts)
-        with open(os.path.join(repo_path,
-                               ".gitreview"),
-                  'w') as gitreview:
-            gitreview.write("""[gerrit]
+        gitreview = """[gerrit]
 host=%s
 port=%s
 project=%s
-""" % (GERRIT_HOST, GERRIT_PORT, project_git))
-        git_command(repo_path, "add .gitreview")
-        cmd = ("commit -a -m'Added .gitreview' --author='%s'"
-               % GERRIT_GITID)
-        git_command(repo_path, cmd)
-        return "push %s HEAD:refs/heads/master"
+""" % (GERRIT_HOST, GERRIT_PORT, project_git)
+        commit_files(repo_path, 'refs/heads/master',
+                     {'.gitreview': gitreview}, 'Added .gitreview',
+                     GERRIT_GITID)
+        return "push %s refs/heads/master:refs/heads/master"
 
 
+@metrics.REGISTRY.timed()
 def update_local_copy(repo_path, track_upstream, git_opts, ssh_env):
-    has_upstream_remote = (
-        'upstream' in git_command_output(repo_path, 'remote')[1])
+    status, upstream_url = git_command_output(
+        repo_path, 'config --get remote.upstream.url')
+    has_upstream_remote = status == 0
     if track_upstream:
         # If we're configured to track upstream but the repo
         # does not have an upstream remote, add one
@@ -398,27 +1036,25 @@ def update_local_copy(repo_path, track_upstream, git_opts, ssh_env):
 
         # If we're configured to track upstream, make sure that
         # the upstream URL matches the config
-        else:
+        elif upstream_url != git_opts['upstream']:
             git_command(
                 repo_path,
                 "remote set-url upstream %(upstream)s" % git_opts)
 
-        # Now that we have any upstreams configured, fetch all of the refs
-        # we might need, pruning remote branches that no longer exist
+        # Bring the local branches up to date with Gerrit, pruning ones
+        # that no longer exist.  A bare clone has no fetch refspec for
+        # origin, so give it explicitly; sync_upstream fetches upstream.
         git_command(
-            repo_path, "remote update --prune", env=ssh_env)
+            repo_path, "fetch --prune origin +refs/heads/*:refs/heads/*",
+            env=ssh_env)
     else:
         # If we are not tracking upstream, then we do not need
         # an upstream remote configured
         if has_upstream_remote:
             git_command(repo_path, "remote rm upstream")
 
-    # TODO(mordred): This is here so that later we can
-    # inspect the master branch for meta-info
-    # Checkout master and reset to the state of origin/master
-    git_command(repo_path, "checkout -b master origin/master")
-
 
+@metrics.REGISTRY.timed()
 def push_to_gerrit(repo_path, project, push_string, remote_url, ssh_env):
     try:
         git_command(repo_path, push_string % remote_url, env=ssh_env)
@@ -428,75 +1064,118 @@ def push_to_gerrit(repo_path, project, push_string, remote_url, ssh_env):
             "Error pushing %s to Gerrit." % project)
 
 
+@metrics.REGISTRY.timed()
 def sync_upstream(repo_path, project, ssh_env):
     git_command(
         repo_path,
         "remote update upstream --prune", env=ssh_env)
     # Any branch that exists in the upstream remote, we want
     # a local branch of, optionally prefixed with the
-    # upstream prefix value
-    for branch in git_command_output(
-            repo_path, "branch -a")[1].split('\n'):
-        if not branch.strip().startswith("remotes/upstream"):
+    # upstream prefix value.  Read every ref once and move the local
+    # branches in a single update-ref.
+    status, out = git_command_output(
+        repo_path, "for-each-ref --format='%(objectname) %(refname)' "
+        "refs/remotes/upstream refs/heads")
+    if status != 0:
+        log.error("Failed to list refs for project: %s" % project['name'])
+        return
+    refs = dict(reversed(line.split(' ', 1))
+                for line in out.split('\n') if line)
+    updates = []
+    for ref, sha in sorted(refs.items()):
+        if not ref.startswith('refs/remotes/upstream/'):
             continue
-        if "->" in branch:
+        local_branch = ref[len('refs/remotes/upstream/'):]
+        if local_branch == 'HEAD':
             continue
-        local_branch = branch.split()[0][len('remotes/upstream/'):]
         if project['upstream_prefix']:
             local_branch = "%s/%s" % (
                 project['upstream_prefix'], local_branch)
-
-        # Check out an up to date copy of the branch, so that
-        # we can push it and it will get picked up below
-        git_command(repo_path, "checkout -b %s %s" % (
-            local_branch, branch))
+        local_ref = 'refs/heads/%s' % local_branch
+        if refs.get(local_ref) == sha:
+            continue
+        updates.append("update %s %s\n" % (local_ref, sha))
+    if updates:
+        status, _ = git_command_output(repo_path, "update-ref --stdin",
+                                       data="".join(updates).encode('utf-8'))
+        if status != 0:
+            log.error("Failed to update upstream branches for project: %s" %
+                      project['name'])
 
     try:
         # Push all of the local branches to similarly named
-        # Branches on gerrit. Also, push all of the tags
+        # Branches on gerrit, and all of the tags, in one go
         git_command(
             repo_path,
-            "push origin refs/heads/*:refs/heads/*",
+            "push origin refs/heads/*:refs/heads/* refs/tags/*:refs/tags/*",
             env=ssh_env)
-        git_command(repo_path, 'push origin --tags', env=ssh_env)
     except Exception:
         log.exception(
             "Error pushing %s to Gerrit." % project['name'])
 
 
+@metrics.REGISTRY.timed()
 def process_acls(project, ACL_DIR, remote_url, repo_path,
-                 ssh_env, gerrit, GERRIT_GITID):
+                 ssh_env, gerrit, GERRIT_GITID, waiter=None,
+                 mirror_path=None):
+    """Push the rendered ACL if it changed; return False on failure.
+
+    If mirror_path is given and its meta/config already matches, nothing
+    is fetched from Gerrit.
+    """
     if not os.path.isfile(os.path.join(ACL_DIR, project['acl_config'])):
-        return
+        return True
+    if mirror_path:
+        try:
+            if mirror_acl_is_current(project, ACL_DIR, mirror_path):
+                log.debug("ACL for %s is current in %s" %
+                          (project['name'], mirror_path))
+                return True
+        except Exception:
+            log.exception("Failed to read meta/config from %s" %
+                          mirror_path)
     try:
-        fetch_config(project, remote_url, repo_path, ssh_env)
-        if not copy_acl_config(project, repo_path, ACL_DIR):
-            # nothing was copied, so we're done
-            return
-        create_groups_file(project, gerrit, repo_path)
-        push_acl_config(project, remote_url, repo_path,
-                        GERRIT_GITID, ssh_env)
+        current, groups = fetch_config(project, remote_url, repo_path,
+                                       ssh_env, waiter)
+        acl = render_acl_config(project, ACL_DIR)
+        if acl_is_current(acl, current, groups):
+            # nothing changed, so we're done
+            return True
+        files = {'project.config': acl}
+        groups = make_groups_file(gerrit, acl)
+        if groups:
+            files['groups'] = groups
+        return push_acl_config(project, remote_url, repo_path, files,
+                               GERRIT_GITID, ssh_env)
     except Exception:
         log.exception(
             "Exception processing ACLS for %s." % project['name'])
-    finally:
-        git_command(repo_path, 'reset --hard')
-        git_command(repo_path, 'checkout master')
-        git_command(repo_path, 'branch -D config')
+        return False
 
 
-def create_gerrit_project(project, project_list, gerrit):
-    if project not in project_list:
+@metrics.REGISTRY.timed()
+def create_gerrit_project(project, inventory, gerrit):
+    if project not in inventory:
         try:
             gerrit.createProject(project)
+            inventory.add(project)
+            inventory.set_heads(project, [])
             return True
         except Exception:
+            # A saved inventory may predate the project
+            listed = parse_project_descriptions(gerrit.listProjects(
+                show_description=True, prefix=project))
+            if project in listed:
+                log.info("%s already exists in Gerrit" % project)
+                inventory.add(project, listed[project])
+                return False
             log.exception(
                 "Exception creating %s in Gerrit." % project)
             raise
     return False
 
 
+@metrics.REGISTRY.timed()
 def create_local_mirror(local_git_dir, project_git,
                         gerrit_system_user, gerrit_system_group):
 
@@ -512,6 +1191,610 @@ def create_local_mirror(local_git_dir, project_git,
                        git_mirror_path))
 
 
+class ProjectLogHandler(logging.Handler):
+    """Hold back log records emitted while a worker processes a project.
+
+    Records are released to the wrapped handler in one block when the
+    project finishes, so output from concurrent jobs is not interleaved.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+        self._local = threading.local()
+
+    def begin(self):
+        self._local.records = []
+
+    def end(self):
+        records = getattr(self._local, 'records', None) or []
+        self._local.records = None
+        with self._lock:
+            for record in records:
+                self.target.handle(record)
+
+    def emit(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            with self._lock:
+                self.target.handle(record)
+        else:
+            records.append(record)
+
+
+def buffer_project_logs():
+    handlers = []
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        wrapper = ProjectLogHandler(handler)
+        root.addHandler(wrapper)
+        handlers.append(wrapper)
+    return handlers
+
+
+class RunContext(object):
+    """Settings and shared connections used to process every project."""
+
+    def __init__(self, registry, gerrit, ssh_env):
+        self.registry = registry
+        self.gerrit = gerrit
+        self.ssh_env = ssh_env
+        self.log_handlers = []
+        # inventory.ServerInventory of the projects on the server
+        self.inventory = None
+        self.state = None
+        self.force = False
+        self.meta_waiter = None
+
+        self.local_git_dir = registry.get_defaults('local-git-dir',
+                                                   '/var/lib/git')
+        self.cache_dir = registry.get_defaults('cache-dir', '/var/tmp/cache')
+        self.acl_dir = registry.get_defaults('acl-dir')
+        self.gerrit_host = registry.get_defaults('gerrit-host')
+        self.gerrit_port = int(registry.get_defaults('gerrit-port', '29418'))
+        self.gerrit_gitid = registry.get_defaults('gerrit-committer')
+        self.gerrit_system_user = registry.get_defaults('gerrit-system-user',
+                                                        'gerrit2')
+        self.gerrit_system_group = registry.get_defaults(
+            'gerrit-system-group', 'gerrit2')
+        self.share_mirror_objects = registry.get_defaults(
+            'share-mirror-objects', True)
+        self.metrics_file = registry.get_defaults('metrics-file')
+
+
+def parse_project(section):
+    project = dict(name=section['project'])
+    project['options'] = section.get('options', dict())
+    project['description'] = section.get('description', None)
+    project['upstream'] = section.get('upstream', None)
+    project['upstream_prefix'] = section.get('upstream-prefix', None)
+    project['track_upstream'] = 'track-upstream' in project['options']
+    project['acl_config'] = section.get('acl-config',
+                                        '%s.config' % project['name'])
+    project['notify'] = section.get('notify', None)
+    project['replicate'] = section.get('replicate', None)
+    project['acl_parameters'] = section.get('acl-parameters', {})
+    return project
+
+
+def project_fingerprint(section, ctx):
+    """Hash everything a run of this project depends on.
+
+    That is the registry section, the ACL template and its rendered
+    output, plus the remote state seen in the server listing (existence
+    and description) and in the local mirror (refs/meta/config), so that
+    changes made on the server are noticed too.  Returns None for
+    projects tracking an upstream, which moves without us knowing; those
+    are never skipped.
+    """
+    project = parse_project(section)
+    if project['track_upstream']:
+        return None
+    template = rendered = None
+    if project['acl_config'] and ctx.acl_dir:
+        template_path = os.path.join(ctx.acl_dir, project['acl_config'])
+        if os.path.isfile(template_path):
+            with open(template_path, 'rb') as fp:
+                template = fp.read()
+            rendered = render_acl_config(project, ctx.acl_dir)
+    inputs = state.hash_data(section, template or b'', rendered or '')
+    return dict(inputs=inputs, acl=template is not None,
+                remote=remote_fingerprint(project['name'], ctx))
+
+
+def remote_fingerprint(name, ctx):
+    """The server state of a project as far as we can see it locally."""
+    mirror_path = os.path.join(ctx.local_git_dir, "%s.git" % name)
+    return dict(exists=name in ctx.inventory,
+                description=ctx.inventory.get(name),
+                meta_config=read_local_ref(mirror_path, 'refs/meta/config'))
+
+
+def expected_fingerprint(section, fingerprint, ctx):
+    """The fingerprint a project should have after a successful apply.
+
+    The description is only set by us for projects without an ACL; for
+    the others whatever the server has is kept.
+    """
+    name = section['project']
+    remote = remote_fingerprint(name, ctx)
+    remote['exists'] = True
+    if not fingerprint['acl'] and section.get('description'):
+        remote['description'] = section['description']
+    return dict(inputs=fingerprint['inputs'], acl=fingerprint['acl'],
+                remote=remote)
+
+
+PROJECT_OK = 'ok'
+PROJECT_SKIPPED = 'skipped'
+PROJECT_FAILED = 'failed'
+
+
+def process_project(section, ctx, actions=None):
+    """Reconcile a single project; never raises.
+
+    If actions (from plan_project) is given, only the work they call for
+    is done.  Returns one of PROJECT_OK, PROJECT_SKIPPED or PROJECT_FAILED.
+    """
+    for handler in ctx.log_handlers:
+        handler.begin()
+    try:
+        with metrics.REGISTRY.span('project', section['project']):
+            outcome = _check_and_process(section, ctx, actions)
+        metrics.REGISTRY.count_project(outcome)
+        return outcome
+    finally:
+        for handler in ctx.log_handlers:
+            handler.end()
+
+
+def _check_and_process(section, ctx, actions):
+    try:
+        fingerprint = None
+        if ctx.state is not None:
+            with metrics.REGISTRY.span('project_fingerprint'):
+                fingerprint = project_fingerprint(section, ctx)
+            if (fingerprint is not None and not ctx.force and
+                    ctx.state.is_current(section['project'], fingerprint)):
+                log.debug("%s is unchanged since the last run, skipping" %
+                          section['project'])
+                return PROJECT_SKIPPED
+        outcome = _process_actions(section, ctx, actions)
+        if fingerprint is not None:
+            if outcome == PROJECT_OK:
+                ctx.state.record(
+                    section['project'],
+                    expected_fingerprint(section, fingerprint, ctx), outcome)
+            elif outcome == PROJECT_FAILED:
+                ctx.state.forget(section['project'])
+        return outcome
+    except Exception:
+        log.exception(
+            "Problems creating %s, moving on." % section['project'])
+        if ctx.state is not None:
+            ctx.state.forget(section['project'])
+        return PROJECT_FAILED
+
+
+def _process_actions(section, ctx, actions):
+    if actions is not None:
+        if PLAN_NOOP in actions:
+            return PROJECT_SKIPPED
+        if PLAN_LIGHT_ACTIONS.issuperset(actions):
+            return _apply_light_actions(section, ctx, actions)
+    return _process_project(section, ctx)
+
+
+def _apply_light_actions(section, ctx, actions):
+    project = parse_project(section)
+    if PLAN_CREATE_MIRROR in actions:
+        create_local_mirror(
+            ctx.local_git_dir, "%s.git" % project['name'],
+            ctx.gerrit_system_user, ctx.gerrit_system_group)
+    if PLAN_SET_DESCRIPTION in actions:
+        ctx.gerrit.updateProject(project['name'], 'description',
+                                 project['description'])
+        ctx.inventory.set_description(project['name'],
+                                      project['description'])
+    return PROJECT_OK
+
+
+def _process_project(section, ctx):
+    gerrit = ctx.gerrit
+    ssh_env = ctx.ssh_env
+    ACL_DIR = ctx.acl_dir
+
+    # Figure out all of the options
+    project = parse_project(section)
+    repo_path = os.path.join(ctx.cache_dir, project['name'])
+
+    # If this project doesn't want to use gerrit, exit cleanly.
+    if 'no-gerrit' in project['options']:
+        return PROJECT_SKIPPED
+
+    project_git = "%s.git" % project['name']
+    remote_url = "ssh://%s:%s/%s" % (
+        ctx.gerrit_host,
+        ctx.gerrit_port,
+        project['name'])
+    git_opts = dict(upstream=project['upstream'],
+                    repo_path=repo_path,
+                    remote_url=remote_url,
+                    mirror_path=None)
+    if ctx.share_mirror_objects:
+        git_opts['mirror_path'] = os.path.join(ctx.local_git_dir,
+                                               project_git)
+
+    discard_work_tree_copy(repo_path)
+
+    # Create the project in Gerrit first, since it will fail
+    # spectacularly if its project directory or local replica
+    # already exist on disk
+    project_created = create_gerrit_project(
+        project['name'], ctx.inventory, gerrit)
+
+    # Create the repo for the local git mirror
+    create_local_mirror(
+        ctx.local_git_dir, project_git,
+        ctx.gerrit_system_user, ctx.gerrit_system_group)
+
+    if not os.path.exists(repo_path) or project_created:
+        # We don't have a local copy already, get one
+
+        # Make Local repo
+        push_string = make_local_copy(
+            repo_path, project, ctx.inventory,
+            git_opts, ssh_env, ctx.gerrit_host, ctx.gerrit_port,
+            project_git, ctx.gerrit_gitid, gerrit)
+    else:
+        # We do have a local copy of it already, make sure it's
+        # in shape to have work done.
+        update_local_copy(
+            repo_path, project['track_upstream'], git_opts, ssh_env)
+
+    #description = (
+    #    find_description_override(repo_path) or description)
+
+    if project_created:
+        push_to_gerrit(
+            repo_path, project['name'], push_string, remote_url, ssh_env)
+        ctx.inventory.forget_heads(project['name'])
+        if project['replicate']:
+            gerrit.replicate(project['name'])
+
+    # If we're configured to track upstream, make sure we have
+    # upstream's refs, and then push them to the appropriate
+    # branches in gerrit
+    if project['track_upstream']:
+        sync_upstream(repo_path, project, ssh_env)
+        ctx.inventory.forget_heads(project['name'])
+
+    if project['acl_config'] and os.path.isfile(os.path.join(ACL_DIR, project['acl_config'])):
+        if not process_acls(
+                project, ACL_DIR, remote_url, repo_path,
+                ssh_env, gerrit, ctx.gerrit_gitid, ctx.meta_waiter,
+                os.path.join(ctx.local_git_dir, project_git)):
+            return PROJECT_FAILED
+    else:
+        if project['description']:
+            gerrit.updateProject(project['name'], 'description', project['description'])
+            ctx.inventory.set_description(project['name'],
+                                          project['description'])
+    return PROJECT_OK
+
+
+PLAN_CREATE = 'create'
+PLAN_CREATE_MIRROR = 'create-mirror'
+PLAN_PUSH_ACL = 'push-acl'
+PLAN_SET_DESCRIPTION = 'set-description'
+PLAN_SYNC_UPSTREAM = 'sync-upstream'
+PLAN_NOOP = 'noop'
+
+# Actions that can be applied without a local working copy
+PLAN_LIGHT_ACTIONS = set([PLAN_CREATE_MIRROR, PLAN_SET_DESCRIPTION])
+
+
+def read_remote_acl_config(ctx, project):
+    """Return the last known refs/meta/config (project.config, groups).
+
+    The local bare mirror is preferred; failing that the copy last fetched
+    into cache-dir is used.  project.config is None if neither has one.
+    """
+    mirror_path = os.path.join(ctx.local_git_dir, "%s.git" % project['name'])
+    current, groups = read_meta_config(mirror_path)
+    if current is not None:
+        return (current, groups)
+    return read_meta_config(
+        os.path.join(ctx.cache_dir, project['name']),
+        'refs/remotes/gerrit-meta/config')
+
+
+@metrics.REGISTRY.timed()
+def plan_project(section, ctx, inventory):
+    """Work out which actions are needed to reconcile one project."""
+    project = parse_project(section)
+    if 'no-gerrit' in project['options']:
+        return [PLAN_NOOP]
+    if project['name'] not in inventory:
+        return [PLAN_CREATE]
+
+    actions = []
+    mirror_path = os.path.join(ctx.local_git_dir, "%s.git" % project['name'])
+    if not os.path.exists(mirror_path):
+        actions.append(PLAN_CREATE_MIRROR)
+    if project['track_upstream']:
+        actions.append(PLAN_SYNC_UPSTREAM)
+
+    if project['acl_config'] and os.path.isfile(
+            os.path.join(ctx.acl_dir, project['acl_config'])):
+        # The same test process_acls uses to decide on pushing
+        current, groups = read_remote_acl_config(ctx, project)
+        if not acl_is_current(render_acl_config(project, ctx.acl_dir),
+                              current, groups):
+            actions.append(PLAN_PUSH_ACL)
+    elif (project['description'] and
+          project['description'] != inventory.get(project['name'])):
+        actions.append(PLAN_SET_DESCRIPTION)
+    return actions or [PLAN_NOOP]
+
+
+def make_plan(sections, ctx):
+    """Return a list of (section, actions) for every section."""
+    plan = []
+    for section in sections:
+        try:
+            actions = plan_project(section, ctx, ctx.inventory)
+        except Exception:
+            log.exception("Problems planning %s, will process it fully." %
+                          section['project'])
+            actions = [PLAN_CREATE]
+        plan.append((section, actions))
+    return plan
+
+
+def print_plan(plan):
+    for section, actions in plan:
+        print("%s: %s" % (section['project'], ", ".join(actions)))
+
+
+def run_projects(sections, ctx, jobs=1, plan=None):
+    """Process sections, up to jobs at a time, and return the results.
+
+    If a plan from make_plan() is given it replaces sections and noop
+    projects are skipped.  The result maps each outcome (PROJECT_OK, ...)
+    to a list of project names.
+    """
+    results = {PROJECT_OK: [], PROJECT_SKIPPED: [], PROJECT_FAILED: []}
+    if plan is None:
+        work = [(section, None) for section in sections]
+    else:
+        work = plan
+
+    def _worker(item):
+        section, actions = item
+        return (section['project'], process_project(section, ctx, actions))
+
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        try:
+            outcomes = pool.imap_unordered(_worker, work)
+            for name, outcome in outcomes:
+                results[outcome].append(name)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for item in work:
+            name, outcome = _worker(item)
+            results[outcome].append(name)
+    return results
+
+
+def log_summary(results):
+    log.info("Processed %d projects: %d ok, %d skipped, %d failed" % (
+        sum(len(names) for names in results.values()),
+        len(results[PROJECT_OK]), len(results[PROJECT_SKIPPED]),
+        len(results[PROJECT_FAILED])))
+    if results[PROJECT_FAILED]:
+        log.error("Failed projects: %s" %
+                  ", ".join(sorted(results[PROJECT_FAILED])))
+
+
+def log_timings(limit=10):
+    """Log where the run spent its time, slowest phases and commands first."""
+    for kind, name, count, total in metrics.REGISTRY.summary()[:limit]:
+        log.debug("%-5s %-30s %6d calls %10.3fs" % (kind, name, count, total))
+
+
+def write_metrics(ctx):
+    if not ctx.metrics_file:
+        return
+    try:
+        metrics.REGISTRY.write_prometheus(ctx.metrics_file)
+    except (IOError, OSError):
+        log.exception("Failed to write metrics to %s" % ctx.metrics_file)
+
+
+class ProjectWatcher(object):
+    """Reconcile single projects as soon as something affects them.
+
+    Triggers are Gerrit events (refs/meta/config updated by someone else,
+    projects created or deleted behind our back) and changes on disk to
+    the projects YAML file or the ACL templates.
+    """
+    log = logging.getLogger("manage_projects.ProjectWatcher")
+
+    def __init__(self, ctx, project_conf, selected=None, jobs=1,
+                 poll_interval=2):
+        self.ctx = ctx
+        self.project_conf = project_conf
+        self.selected = selected
+        self.poll_interval = poll_interval
+        self.pool = ThreadPool(max(jobs, 1))
+        self._lock = threading.Lock()
+        self._running = set()
+        self._rerun = set()
+        # Projects triggered while the initial run goes on, None after it
+        self._held = set()
+        self._mtimes = self._file_mtimes()
+
+    def _file_mtimes(self):
+        mtimes = {}
+        paths = self.ctx.registry.source_paths()
+        if self.ctx.acl_dir and os.path.isdir(self.ctx.acl_dir):
+            for root, dirs, files in os.walk(self.ctx.acl_dir):
+                paths.extend(os.path.join(root, f) for f in files)
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                pass
+        return mtimes
+
+    def wanted(self, name):
+        section = self.ctx.registry.get(name)
+        if section is None:
+            return False
+        return not self.selected or self.selected.matches(section)
+
+    def handle_event(self, event):
+        """Return the names of projects affected by a Gerrit event."""
+        if self.ctx.meta_waiter:
+            self.ctx.meta_waiter.handle_event(event)
+        self.ctx.inventory.handle_event(event)
+        etype = event.get('type')
+        name = None
+        if etype == 'ref-updated':
+            update = event.get('refUpdate', {})
+            submitter = event.get('submitter', {}).get('username')
+            if (update.get('refName') == 'refs/meta/config' and
+                    submitter != self.ctx.gerrit.username):
+                name = update.get('project')
+        elif etype in ('project-created', 'project-deleted'):
+            name = event.get('projectName')
+        if name and self.wanted(name):
+            self.log.info("%s event for %s" % (etype, name))
+            return set([name])
+        return set()
+
+    def check_files(self):
+        """Return the names of projects whose inputs changed on disk."""
+        mtimes = self._file_mtimes()
+        if mtimes == self._mtimes:
+            return set()
+        changed = set(path for path in set(mtimes) | set(self._mtimes)
+                      if mtimes.get(path) != self._mtimes.get(path))
+        self._mtimes = mtimes
+
+        names = set()
+        old_configs = self.ctx.registry.configs
+        sources = set(self.ctx.registry.source_paths())
+        registry_changed = changed & (sources | set(
+            path for path in changed
+            if os.path.dirname(path) == self.ctx.registry.fragments_dir))
+        if registry_changed:
+            try:
+                self.ctx.registry = ProjectsRegistry(
+                    self.ctx.registry.ini_file, self.project_conf)
+            except Exception:
+                self.log.exception("Failed to reload %s, keeping the "
+                                   "previous version" % self.project_conf)
+                return set()
+            for name, section in self.ctx.registry.configs.items():
+                if old_configs.get(name) != section:
+                    names.add(name)
+        templates = set(os.path.relpath(path, self.ctx.acl_dir)
+                        for path in changed - registry_changed)
+        if templates:
+            for section in self.ctx.registry.configs_list:
+                if parse_project(section)['acl_config'] in templates:
+                    names.add(section['project'])
+        names = set(name for name in names if self.wanted(name))
+        if names:
+            self.log.info("Inputs changed on disk for %s" %
+                          ", ".join(sorted(names)))
+        return names
+
+    def _reconcile(self, name):
+        while True:
+            section = self.ctx.registry.get(name)
+            if section is not None:
+                process_project(section, self.ctx)
+                self.ctx.state.save()
+                self.ctx.inventory.save()
+                write_metrics(self.ctx)
+            with self._lock:
+                if name not in self._rerun:
+                    self._running.discard(name)
+                    return
+                self._rerun.discard(name)
+
+    def reconcile(self, names):
+        for name in names:
+            with self._lock:
+                if name in self._running:
+                    # Pick up the new trigger once the current pass ends
+                    self._rerun.add(name)
+                    continue
+                self._running.add(name)
+            self.pool.apply_async(self._reconcile, (name,))
+
+    def start(self):
+        """Consume Gerrit events on a background thread.
+
+        The waiter and the inventory are fed right away, but projects the
+        events trigger are only reconciled once release() was called.
+        """
+        thread = threading.Thread(target=self._consume)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _consume(self):
+        while True:
+            names = set()
+            for event in self.ctx.gerrit.getEvents(
+                    100, timeout=self.poll_interval):
+                try:
+                    names |= self.handle_event(event)
+                except Exception:
+                    self.log.exception("Exception handling Gerrit event")
+            if names:
+                self._trigger(names)
+
+    def _trigger(self, names):
+        with self._lock:
+            if self._held is not None:
+                self._held |= names
+                return
+        self.reconcile(names)
+
+    def release(self, touched):
+        """End the initial run and reconcile what it held back.
+
+        Projects in touched were processed by the initial run, which
+        caused their events itself, so those are dropped.
+        """
+        with self._lock:
+            names = self._held - set(touched)
+            dropped = len(self._held) - len(names)
+            self._held = None
+        if dropped:
+            self.log.debug("Ignoring events for %d projects the initial "
+                           "run processed" % dropped)
+        if names:
+            self.reconcile(names)
+
+    def run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            names = self.check_files()
+            if names:
+                self.reconcile(names)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Manage projects')
     parser.add_argument('-v', dest='verbose', action='store_true',
@@ -523,10 +1806,30 @@ def main():
     parser.add_argument('--project_conf', dest='project_conf',
                         help='Project YAML configuration file',
                         default='/home/gerrit2/projects.yaml')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='number of projects to process concurrently')
+    parser.add_argument('--plan', dest='plan', action='store_true',
+                        help='print the actions each project needs and exit')
+    parser.add_argument('--skip-noop', dest='skip_noop', action='store_true',
+                        help='plan first and only process projects that '
+                             'need changes')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='process projects even if nothing changed '
+                             'since the last successful run')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help='after the initial run keep running and '
+                             'reconcile projects as Gerrit events or file '
+                             'changes affect them')
+    parser.add_argument('--trace', dest='trace',
+                        help='append a JSON line for every phase, SSH '
+                             'command and subprocess to this file '
+                             '(overrides trace-file in the config)')
     #parser.add_argument('--nocleanup', action='store_true',
     #                    help='do not remove temp directories')
     parser.add_argument('projects', metavar='project', nargs='*',
-                        help='name of project(s) to process')
+                        help='project(s) to process: a name, a glob such '
+                             'as "infra/*", re:REGEX, acl:ACL_CONFIG or '
+                             'option:OPTION')
     args = parser.parse_args()
 
     if args.debug:
@@ -546,115 +1849,130 @@ def main():
         if not os.path.exists(f):
             logging.error('File must exist! %s' % f)
             sys.exit(1)
-    registry = ProjectsRegistry(args.conf, args.project_conf)
+    with metrics.REGISTRY.span('load_registry'):
+        registry = ProjectsRegistry(args.conf, args.project_conf)
+    trace_file = args.trace or registry.get_defaults('trace-file')
+    if trace_file:
+        metrics.REGISTRY.open_trace(trace_file)
+    global _command_timeout
+    _command_timeout = float(registry.get_defaults('command-timeout', '1800'))
+    run_timeout = registry.get_defaults('run-timeout')
+    if run_timeout:
+        # Past this, failures are no longer retried
+        retry.RUN.set(float(run_timeout))
 
-    LOCAL_GIT_DIR = registry.get_defaults('local-git-dir', '/var/lib/git')
-    CACHE_DIR = registry.get_defaults('cache-dir',
-                                      '/var/tmp/cache')
-    ACL_DIR = registry.get_defaults('acl-dir')
     GERRIT_HOST = registry.get_defaults('gerrit-host')
     GERRIT_PORT = int(registry.get_defaults('gerrit-port', '29418'))
     GERRIT_USER = registry.get_defaults('gerrit-user')
     GERRIT_KEY = registry.get_defaults('gerrit-key')
-    GERRIT_GITID = registry.get_defaults('gerrit-committer')
-    GERRIT_SYSTEM_USER = registry.get_defaults('gerrit-system-user', 'gerrit2')
-    GERRIT_SYSTEM_GROUP = registry.get_defaults('gerrit-system-group',
-                                                'gerrit2')
-
-    gerrit = gerritlib.Gerrit(GERRIT_HOST,
-                              GERRIT_USER,
-                              GERRIT_PORT,
-                              GERRIT_KEY)
-    project_list = gerrit.listProjects()
+    GERRIT_SSH_CONNECTIONS = int(
+        registry.get_defaults('gerrit-ssh-connections', '1'))
+    GERRIT_MAX_IN_FLIGHT = int(
+        registry.get_defaults('gerrit-max-in-flight', '8'))
+    # SSH commands and git over SSH share Gerrit's sshd threads with
+    # people; leave some of them free.
+    global _gerrit_url
+    _gerrit_url = "ssh://%s:%s/" % (GERRIT_HOST, GERRIT_PORT)
+    global _transport_limiter
+    _transport_limiter = concurrency.AdaptiveLimiter(
+        int(registry.get_defaults('gerrit-max-sessions', '8')),
+        int(registry.get_defaults('gerrit-reserved-sessions', '0')))
+
+    GERRIT_BACKEND = registry.get_defaults('gerrit-backend', 'ssh')
+
+    if GERRIT_BACKEND == 'rest':
+        gerrit = gerritlib.GerritREST(
+            GERRIT_HOST,
+            GERRIT_USER,
+            GERRIT_PORT,
+            GERRIT_KEY,
+            pool_size=GERRIT_SSH_CONNECTIONS,
+            url=registry.get_defaults('gerrit-url'),
+            http_username=registry.get_defaults('gerrit-http-user'),
+            http_password=registry.get_defaults('gerrit-http-password'),
+            http_pool_size=int(
+                registry.get_defaults('gerrit-http-connections', '4')),
+            max_in_flight=GERRIT_MAX_IN_FLIGHT,
+            limiter=_transport_limiter)
+    elif GERRIT_BACKEND == 'ssh':
+        gerrit = gerritlib.Gerrit(GERRIT_HOST,
+                                  GERRIT_USER,
+                                  GERRIT_PORT,
+                                  GERRIT_KEY,
+                                  pool_size=GERRIT_SSH_CONNECTIONS,
+                                  max_in_flight=GERRIT_MAX_IN_FLIGHT,
+                                  limiter=_transport_limiter)
+    else:
+        logging.error('Unknown gerrit-backend %s, use ssh or rest' %
+                      GERRIT_BACKEND)
+        sys.exit(1)
+    selector = ProjectSelector(args.projects)
+    sections = selector.select(registry)
     ssh_env = make_ssh_wrapper(GERRIT_USER, GERRIT_KEY)
+    ctx = RunContext(registry, gerrit, ssh_env)
+    ctx.force = args.force
+    ctx.inventory = inventory.ServerInventory(
+        os.path.join(ctx.cache_dir, 'inventory.json'),
+        float(registry.get_defaults('inventory-ttl', '0'))).load()
+    ctx.state = state.ProjectState(
+        os.path.join(ctx.cache_dir, 'state.json')).load()
+    if ctx.acl_dir:
+        acl_environment(ctx.acl_dir, os.path.join(ctx.cache_dir, 'jinja'))
+    gerrit.useGroupIndex(
+        os.path.join(ctx.cache_dir, 'groups.json'),
+        float(registry.get_defaults('group-cache-ttl', '0')))
 
     try:
-
-        for section in registry.configs_list:
-            project = dict(name=section['project'])
-            if args.projects and project['name'] not in args.projects:
-                continue
-
-            try:
-                # Figure out all of the options
-                project['options']= section.get('options', dict())
-                project['description'] = section.get('description', None)
-                project['upstream'] = section.get('upstream', None)
-                project['upstream_prefix'] = section.get('upstream-prefix', None)
-                project['track_upstream'] = 'track-upstream' in project['options']
-                project['acl_config'] = section.get('acl-config',
-                                                    '%s.config' % project['name'])
-                project['notify'] = section.get('notify', None)
-                project['replicate'] = section.get('replicate', None)
-                repo_path = os.path.join(CACHE_DIR, project['name'])
-
-                # If this project doesn't want to use gerrit, exit cleanly.
-                if 'no-gerrit' in project['options']:
-                    continue
-
-                project_git = "%s.git" % project['name']
-                remote_url = "ssh://%s:%s/%s" % (
-                    GERRIT_HOST,
-                    GERRIT_PORT,
-                    project['name'])
-                git_opts = dict(upstream=project['upstream'],
-                                repo_path=repo_path,
-                                remote_url=remote_url)
-
-                # Create the project in Gerrit first, since it will fail
-                # spectacularly if its project directory or local replica
-                # already exist on disk
-                project_created = create_gerrit_project(
-                    project['name'], project_list, gerrit)
-
-                # Create the repo for the local git mirror
-                create_local_mirror(
-                    LOCAL_GIT_DIR, project_git,
-                    GERRIT_SYSTEM_USER, GERRIT_SYSTEM_GROUP)
-
-                if not os.path.exists(repo_path) or project_created:
-                    # We don't have a local copy already, get one
-
-                    # Make Local repo
-                    push_string = make_local_copy(
-                        repo_path, project, project_list,
-                        git_opts, ssh_env, GERRIT_HOST, GERRIT_PORT,
-                        project_git, GERRIT_GITID, gerrit)
-                else:
-                    # We do have a local copy of it already, make sure it's
-                    # in shape to have work done.
-                    update_local_copy(
-                        repo_path, project['track_upstream'], git_opts, ssh_env)
-
-                #description = (
-                #    find_description_override(repo_path) or description)
-
-                if project_created:
-                    push_to_gerrit(
-                        repo_path, project['name'], push_string, remote_url, ssh_env)
-                    if project['replicate']:
-                        gerrit.replicate(project['name'])
-
-                # If we're configured to track upstream, make sure we have
-                # upstream's refs, and then push them to the appropriate
-                # branches in gerrit
-                if project['track_upstream']:
-                    sync_upstream(repo_path, project, ssh_env)
-
-                if project['acl_config'] and os.path.isfile(os.path.join(ACL_DIR, project['acl_config'])):
-                    process_acls(
-                        project, ACL_DIR, remote_url, repo_path,
-                        ssh_env, gerrit, GERRIT_GITID)
-                else:
-                    if project['description']:
-                        gerrit.updateProject(project['name'], 'description', project['description'])
-
-            except Exception:
-                log.exception(
-                    "Problems creating %s, moving on." % project['name'])
-                continue
+        prefixes = selector.prefixes(sections)
+        with metrics.REGISTRY.span('list_projects'):
+            ctx.inventory.refresh(gerrit, prefixes)
+        plan = None
+        if args.plan or args.skip_noop:
+            plan = make_plan(sections, ctx)
+            if args.plan:
+                print_plan(plan)
+                return
+        watcher = None
+        if args.watch or registry.get_defaults('stream-events', False):
+            gerrit.startWatching(
+                queue_size=int(registry.get_defaults('event-queue-size',
+                                                     '10000')),
+                overflow=registry.get_defaults(
+                    'event-queue-overflow', gerritlib.OVERFLOW_DROP_OLDEST))
+            ctx.meta_waiter = MetaConfigWaiter(gerrit)
+            if args.watch:
+                # ProjectWatcher feeds the waiter, already during the
+                # initial run
+                watcher = ProjectWatcher(ctx, args.project_conf, selector,
+                                         args.jobs).start()
+            else:
+                ctx.meta_waiter.start([ctx.inventory.handle_event])
+        if args.jobs > 1:
+            ctx.log_handlers = buffer_project_logs()
+        collect_branch_heads(ctx, sections, prefixes)
+        results = run_projects(sections, ctx, args.jobs, plan)
+        log_summary(results)
+        log_timings()
+        log.debug("Gerrit session limit ended at %d of %d after %d "
+                  "back-offs" % (_transport_limiter.limit,
+                                 _transport_limiter.maximum,
+                                 _transport_limiter.backoffs))
+        write_metrics(ctx)
+        if args.watch:
+            ctx.state.save()
+            # Every trigger means something may have drifted, so do not
+            # let unchanged inputs short-circuit the check.
+            ctx.force = True
+            # run-timeout only bounds the initial run
+            retry.RUN.set(None)
+            watcher.release(results[PROJECT_OK] + results[PROJECT_FAILED])
+            watcher.run()
     finally:
+        ctx.state.save()
+        ctx.inventory.save()
+        gerrit.close()
         os.unlink(ssh_env['GIT_SSH'])
+        metrics.REGISTRY.close_trace()
 
 if __name__ == "__main__":
     main()
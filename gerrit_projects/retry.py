@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Retries with jittered exponential backoff and deadlines.
+
+A RetryPolicy waits between attempts for a random time between half and
+all of initial * multiplier ** n, capped at maximum, so that a hiccup is
+retried within milliseconds and clients failing together do not come back
+in lockstep.  Attempts stop once the policy's attempts are used up or when
+the next wait would pass its per-operation timeout or the run deadline
+(RUN), and errors that the policy does not consider retryable fail
+straight away.
+"""
+
+import logging
+import random
+import time
+
+import gerrit_projects.concurrency as concurrency
+
+log = logging.getLogger("manage_projects.retry")
+
+# Lower case fragments of errors and git output that a retry will not fix
+PERMANENT_MARKERS = ('permission denied', 'authentication failed',
+                     'host key verification failed',
+                     'could not resolve hostname',
+                     'does not appear to be a git repository',
+                     'not a git repository')
+# Lower case fragments of errors and git output from passing network
+# trouble
+TRANSIENT_MARKERS = ('connection refused', 'timed out', 'broken pipe',
+                     'early eof', 'hung up unexpectedly', 'not active',
+                     'temporarily unavailable', 'error reading ssh protocol')
+
+
+def permanent(error):
+    """Whether error (an exception or output text) will happen again."""
+    text = str(error or '').lower()
+    return any(marker in text for marker in PERMANENT_MARKERS)
+
+
+def transient(error):
+    """Whether error (an exception or output text) is worth retrying."""
+    if permanent(error):
+        return False
+    if concurrency.is_overload(error):
+        return True
+    text = str(error or '').lower()
+    return any(marker in text for marker in TRANSIENT_MARKERS)
+
+
+class Deadline(object):
+    """A point in time after which no new attempt is started."""
+
+    def __init__(self, timeout=None):
+        self.set(timeout)
+
+    def set(self, timeout):
+        """Expire timeout seconds from now, or never if it is None."""
+        self.expires = None if timeout is None else time.time() + timeout
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.time())
+
+
+# Deadline of the whole run, set by main() from run-timeout
+RUN = Deadline()
+
+
+class RetryPolicy(object):
+    """How often, how fast and which failures to retry.
+
+    attempts of 0 means no limit other than the deadlines.  A policy for
+    something that should outlive the run, like the event stream, is
+    created with run_deadline=False.
+    """
+
+    def __init__(self, initial=0.05, maximum=2.0, multiplier=2.0,
+                 attempts=0, timeout=None, retryable=transient,
+                 run_deadline=True):
+        self.initial = float(initial)
+        self.maximum = float(maximum)
+        self.multiplier = float(multiplier)
+        self.attempts = int(attempts)
+        self.timeout = timeout
+        self.retryable = retryable
+        self.run_deadline = run_deadline
+
+    def delay(self, failures):
+        """Jittered wait after the given number of consecutive failures."""
+        cap = min(self.maximum,
+                  self.initial * self.multiplier ** max(0, failures - 1))
+        return random.uniform(cap / 2, cap)
+
+    def backoff(self, failures, deadline=None, sleep=time.sleep):
+        """Wait before the next attempt; return False if there is none."""
+        if self.attempts and failures >= self.attempts:
+            return False
+        delay = self.delay(failures)
+        for limit in (deadline, RUN if self.run_deadline else None):
+            remaining = limit.remaining() if limit is not None else None
+            if remaining is not None and delay >= remaining:
+                return False
+        sleep(delay)
+        return True
+
+    def tries(self, sleep=time.sleep):
+        """Yield attempt numbers from 1, backing off before each new one.
+
+        The caller breaks out of the loop once an attempt succeeded or
+        failed for good.
+        """
+        deadline = Deadline(self.timeout)
+        failures = 0
+        while True:
+            yield failures + 1
+            failures += 1
+            if not self.backoff(failures, deadline, sleep):
+                return
+
+    def call(self, func, *args, **kwargs):
+        """Return func(*args, **kwargs), retrying retryable exceptions."""
+        deadline = Deadline(self.timeout)
+        failures = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                failures += 1
+                if (not self.retryable(e) or
+                        not self.backoff(failures, deadline)):
+                    raise
+                log.debug("Retrying %s after failure %d: %s" % (
+                    getattr(func, '__name__', func), failures, e))
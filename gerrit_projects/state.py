@@ -0,0 +1,86 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class ProjectState(object):
+    """Remember what each project looked like after its last good run.
+
+    The state is a JSON file mapping project name to the fingerprint of
+    its inputs and of the remote state it was left in, so unchanged
+    projects can be skipped on the next run.
+    """
+    log = logging.getLogger("manage_projects.ProjectState")
+
+    def __init__(self, path):
+        self.path = path
+        self.projects = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                self.projects = json.load(fp).get('projects', {})
+        except (IOError, ValueError):
+            self.log.debug("No usable state in %s, starting fresh" %
+                           self.path)
+            self.projects = {}
+        return self
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmpname = '%s.tmp' % self.path
+            with open(tmpname, 'w') as fp:
+                json.dump(dict(projects=self.projects), fp,
+                          indent=1, sort_keys=True)
+            os.rename(tmpname, self.path)
+            self._dirty = False
+
+    def is_current(self, name, fingerprint):
+        with self._lock:
+            entry = self.projects.get(name)
+        return bool(entry) and entry.get('fingerprint') == fingerprint
+
+    def record(self, name, fingerprint, outcome):
+        with self._lock:
+            self.projects[name] = dict(fingerprint=fingerprint,
+                                       outcome=outcome,
+                                       timestamp=int(time.time()))
+            self._dirty = True
+
+    def forget(self, name):
+        with self._lock:
+            if self.projects.pop(name, None) is not None:
+                self._dirty = True
+
+
+def hash_data(*items):
+    """Return a stable sha1 hex digest of JSON-serialisable items."""
+    digest = hashlib.sha1()
+    for item in items:
+        if not isinstance(item, bytes):
+            item = json.dumps(item, sort_keys=True).encode('utf-8')
+        digest.update(item)
+        digest.update(b'\0')
+    return digest.hexdigest()